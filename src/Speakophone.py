@@ -9,14 +9,92 @@ Using ARPABet "letters"
 @author: Keith
 """
 
-import sounddevice as sd
 import numpy as np
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, sosfilt, resample_poly
 import scipy.io.wavfile as wv
 from pathlib import Path
+import argparse
+import contextlib
+import copy
+import hashlib
+import math
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import json
+import logging
+import mmap
 import os
+import queue
 import re
+import shutil
+import struct
+import sys
+import threading
+import time
 
+#Playback needs sounddevice and PortAudio, which headless machines may not have
+try:
+    import sounddevice as sd
+except (ImportError, OSError):
+    sd = None
+
+logger = logging.getLogger(__name__)
+
+
+#The rate the bundled samples were recorded at, and the default output rate
+DEFAULT_FS = 44100
+
+SAMPLE_CACHE_FILENAME = ".speakophone_samples.npz"
+SAMPLE_CACHE_VERSION = 2
+
+#The most memory in bytes of zero-padded clips PreprocessPipeline filters at once
+FILTER_BATCH_BYTES = 4 * 1024 * 1024
+
+#Layout of the compiled dictionary index header: magic, source file size,
+#source file mtime (ns), word count, phone name count.
+CMU_INDEX_MAGIC = b"SPKDICT1"
+CMU_INDEX_HEADER = struct.Struct("<8sQqII4x")
+CMU_INDEX_PHONE_WIDTH = 4
+
+NGRAM_RUNS_VERSION = 1
+NGRAM_RUNS_MAX_ENTRIES = 16
+
+SAMPLE_BANK_MAGIC = b"SPKBANK1"
+SAMPLE_BANK_HEADER = struct.Struct("<8sIII4x")
+
+#RIFF/WAVE header for a single "fmt " and "data" chunk, as written by AudioStreamWriter
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+WAV_UNKNOWN_SIZE = 0xFFFFFFFF
+
+#The end of a sentence or paragraph, for splitting documents into chunks
+SENTENCE_END_PATTERN = re.compile(r"[.!?]+(?=\s|$)|\n[ \t]*\n")
+
+#The 40 phones of the CMU Sphinx set, in phone ID order
+SPHINX_PHONES = ["AA", "AE", "AH", "AO", "AW", "AY", "B", "CH", "D", "DH",
+                 "EH", "ER", "EY", "F", "G", "HH", "IH", "IY", "JH", "K",
+                 "L", "M", "N", "NG", "OW", "OY", "P", "R", "S", "SH",
+                 "T", "TH", "UH", "UW", "V", "W", "Y", "Z", "ZH", "SIL"]
+
+#Dictionaries shared between Speakophone instances, see shared_cmu_dict
+_shared_dicts = dict()
+_shared_dicts_lock = threading.Lock()
+
+
+
+def _sound_device():
+    """
+    Gets the sounddevice module for playback.
+    
+    Raises:
+        RuntimeError if sounddevice (or the PortAudio library it needs) is not
+        available.
+    """
+    if sd is None:
+        raise RuntimeError("Audio playback needs the sounddevice package and PortAudio; "
+                           "write to a file instead")
+    return sd
 
 
 def butter_lowpass(cutoff, fs, order=5):
@@ -41,11 +119,37 @@ def butter_lowpass(cutoff, fs, order=5):
     return b, a
 
 
+@lru_cache(maxsize=None)
+def butter_lowpass_sos(cutoff, fs, order=5):
+    """
+    Creates a Butterworth Low Pass filter with the specified parameters in
+    second-order sections form, which is numerically stable for high orders.
+    Designs are cached, so each (cutoff, fs, order) is only designed once.
+    See scipy.signal.butter for more detail.
+    
+    Args:
+        cutoff: The cutoff frequency in Hz (or whatever the same units as Fs)
+        
+        fs: The sampling frequency of the system.
+        
+        order: order of the filter, defaults to 5.
+        
+    Returns:
+        sos (ndarray): The second-order sections of the IIR filter.  This is
+        shared between callers and must not be modified.
+    """
+    nyq = 0.5 * fs
+    normal_cutoff = cutoff / nyq
+    sos = butter(order, normal_cutoff, btype='low', analog=False, output='sos')
+    return sos
+
+
 def butter_lowpass_filter(data, cutoff, fs, order=5):
     """
     Applies Butterworth Low Pass filter with the specified parameters to the 
-    data passed in.
-    See scipy.signal.butter and scipy.signal.lfilter for more detail.
+    data passed in.  The filter is applied as second-order sections along 
+    the last axis, so a 2D array filters each row as a separate clip.
+    See scipy.signal.butter and scipy.signal.sosfilt for more detail.
     
     Args:
         data: The input data samples to be filtered.
@@ -59,8 +163,8 @@ def butter_lowpass_filter(data, cutoff, fs, order=5):
     Returns:
         An array containing the filtered data.
     """
-    b, a = butter_lowpass(cutoff, fs, order=order)
-    y = lfilter(b, a, data)
+    sos = butter_lowpass_sos(cutoff, fs, order=order)
+    y = sosfilt(sos, data)
     return y
 
 
@@ -85,18 +189,338 @@ def trim_silence(audio, threshold=200):
         the audio are less than the threshold.
     """
     if audio.max() < threshold:
-        print("Trimming everything below threshold, returning empty")
+        logger.debug("Trimming everything below threshold, returning empty")
         return np.empty(1)
     
     #Get index of first/last value larger than 200
     transient_start_index = np.where(abs(audio) > threshold)[0][0]
     transient_stop_index = np.where(abs(audio) > threshold)[0][-1]
-    print("trimming to: " + str(transient_start_index) + ":" + str(transient_stop_index))
+    logger.debug("trimming to: %d:%d", transient_start_index, transient_stop_index)
     
     return audio[transient_start_index:transient_stop_index]
 
 
-def load_samples(directory):
+def map_in_pool(func, jobs, workers=1, pool="process", initializer=None, initargs=(),
+                chunksize=1):
+    """
+    Calls func with each tuple of arguments in jobs, optionally spreading the
+    calls across a pool of worker processes or threads.  Results are always
+    returned in the same order as the jobs, so the output is identical to a
+    serial loop.
+    
+    Args:
+        func: The function to call.  It must be defined at module level when
+        a process pool is used so that it can be pickled.
+        
+        jobs: A list of argument tuples, one per call.
+        
+        workers (optional): The number of workers.  1 (the default) runs the
+        calls serially in this process, None uses one worker per CPU.
+        
+        pool (optional): "process" or "thread", defaults to "process".
+        
+        initializer (optional): A function called with initargs once in each
+        worker before it runs any jobs (or once in this process when running
+        serially), defaults to None.
+        
+        initargs (optional): The arguments for initializer.
+        
+        chunksize (optional): The number of jobs sent to a worker process at
+        a time, defaults to 1.
+        
+    Raises:
+        ValueError if pool is not a recognized pool type.
+        
+    Returns:
+        A list with the result of each call.
+    """
+    return list(imap_in_pool(func, jobs, workers, pool, initializer, initargs, chunksize))
+
+
+def imap_in_pool(func, jobs, workers=1, pool="process", initializer=None, initargs=(),
+                 chunksize=1):
+    """
+    The same as map_in_pool, but as a generator which yields each result in
+    order as soon as it and every result before it are ready, so that they 
+    can be consumed while later jobs are still running.  Takes the same 
+    arguments as map_in_pool.
+    
+    Raises:
+        ValueError if pool is not a recognized pool type.
+        
+    Yields:
+        The result of each call, in the order of the jobs.
+    """
+    if workers == 1 or len(jobs) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for job in jobs:
+            yield func(*job)
+        return
+    
+    if pool == "process":
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    elif pool == "thread":
+        executor = ThreadPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    else:
+        raise ValueError("Unknown pool type \"{0}\"".format(pool))
+    
+    with executor:
+        yield from executor.map(func, *zip(*jobs), chunksize=chunksize)
+
+
+def _length_batches(indexes, lengths, max_samples):
+    """
+    Groups indexes into batches in order of their lengths, so that each 
+    batch padded to its longest length holds at most max_samples samples, 
+    or is a single index longer than that.
+    
+    Yields:
+        Lists of indexes, each ordered by length so the last is the longest.
+    """
+    batch = list()
+    for length, i in sorted(zip(lengths, indexes)):
+        if len(batch) > 0 and (len(batch) + 1) * length > max_samples:
+            yield batch
+            batch = list()
+        batch.append(i)
+    if len(batch) > 0:
+        yield batch
+
+
+class PreprocessPipeline:
+    
+    """
+    The preprocessing applied to samples when they are loaded, as a pipeline
+    of trim -> filter -> resample -> quantize stages.  Any stage can be 
+    switched off by passing None for its setting.  Clips with the same sample
+    frequency are filtered together in batches: they are zero-padded into the
+    rows of one array, which leaves each clip's output unchanged since the 
+    filter is causal.  Clips are batched in order of length and each batch is
+    kept to FILTER_BATCH_BYTES, so padding costs little memory and one long
+    recording does not pad out every other clip.  Resampling uses a 
+    polyphase filter, and converts each clip from its own rate so that banks
+    of mixed rates come out uniform.
+    
+    Args:
+        threshold (optional): The trim_silence threshold, defaults to 300.
+        None skips trimming.
+        
+        cutoff (optional): The lowpass cutoff in Hz, defaults to 5000.  None
+        skips filtering.
+        
+        order (optional): The lowpass filter order, defaults to 6.
+        
+        dtype (optional): The sample type to quantize to, defaults to 
+        "int16".  None skips quantizing.
+        
+        target_fs (optional): The sample frequency in Hz to resample every 
+        clip to, defaults to None which leaves clips at their own rates.
+    """
+    
+    def __init__(self, threshold=300, cutoff=5000, order=6, dtype="int16", target_fs=None):
+        self.threshold = threshold
+        self.cutoff = cutoff
+        self.order = order
+        self.dtype = dtype
+        self.target_fs = target_fs
+        
+        
+    def settings(self):
+        """
+        Gets the pipeline's settings, which determine its output.
+        
+        Returns:
+            A dict of the stage settings.
+        """
+        return {"threshold": self.threshold, "cutoff": self.cutoff, 
+                "order": self.order, "dtype": self.dtype, "filter": "sos",
+                "target_fs": self.target_fs}
+    
+    
+    def process(self, clips):
+        """
+        Runs clips through the pipeline.
+        
+        Args:
+            clips: A list of (audio, fs) tuples, where audio is a NumPy array
+            of samples and fs its sample frequency.
+            
+        Returns:
+            A list of the processed NumPy arrays, in the same order.
+        """
+        results = [audio for audio, _ in clips]
+        
+        if self.threshold is not None:
+            results = [trim_silence(audio, threshold=self.threshold) for audio in results]
+        
+        if self.cutoff is not None:
+            by_fs = dict()
+            for i, (_, fs) in enumerate(clips):
+                by_fs.setdefault(fs, list()).append(i)
+            for fs, indexes in by_fs.items():
+                lengths = [len(results[i]) for i in indexes]
+                for batch_indexes in _length_batches(indexes, lengths, FILTER_BATCH_BYTES // 8):
+                    batch = np.zeros((len(batch_indexes), len(results[batch_indexes[-1]])))
+                    for row, i in enumerate(batch_indexes):
+                        batch[row, :len(results[i])] = results[i]
+                    batch = butter_lowpass_filter(batch, self.cutoff, fs, order=self.order)
+                    for row, i in enumerate(batch_indexes):
+                        results[i] = batch[row, :len(results[i])]
+        
+        if self.target_fs is not None:
+            for i, (audio, fs) in enumerate(clips):
+                if fs != self.target_fs:
+                    divisor = math.gcd(int(self.target_fs), int(fs))
+                    results[i] = resample_poly(results[i], int(self.target_fs) // divisor, 
+                                               int(fs) // divisor)
+                    #Keep the resampler's ringing from wrapping around when quantized
+                    if np.issubdtype(audio.dtype, np.integer):
+                        limits = np.iinfo(audio.dtype)
+                        results[i] = np.clip(results[i], limits.min, limits.max)
+        
+        if self.dtype is not None:
+            results = [audio.astype(self.dtype) for audio in results]
+        return results
+
+
+def read_wav_file(joined_path):
+    """
+    Reads a single ".wav" file.
+    
+    Args:
+        joined_path: The path to the ".wav" file to load.
+        
+    Returns:
+        name, fs, wav_array: The filename (minus .wav), the sample frequency
+        and a NumPy array of the samples.
+    """
+    p = Path(joined_path)
+    name = p.resolve().stem.strip()
+    
+    fs, wav_array = wv.read(joined_path)
+    logger.debug("Loaded %s: %s with %d samples at %d Hz", p, name, len(wav_array), fs)
+    return name, fs, wav_array
+
+
+def process_wav_files(joined_paths, pipeline=None):
+    """
+    Reads a batch of ".wav" files and runs them through a preprocessing 
+    pipeline together.
+    
+    Args:
+        joined_paths: A list of paths to the ".wav" files to load.
+        
+        pipeline (optional): The PreprocessPipeline to apply, defaults to None
+        which leaves the samples as they were read.
+        
+    Returns:
+        A list of (name, wav_array) tuples in the same order as the paths.
+    """
+    loaded = [read_wav_file(path) for path in joined_paths]
+    arrays = [wav_array for _, _, wav_array in loaded]
+    if pipeline is not None:
+        arrays = pipeline.process([(wav_array, fs) for _, fs, wav_array in loaded])
+    return [(name, wav_array) for (name, _, _), wav_array in zip(loaded, arrays)]
+
+
+def load_wav_files(joined_paths, pipeline=None, workers=1, pool="process"):
+    """
+    Reads and preprocesses ".wav" files, spreading them across a pool of 
+    workers in batches.  The results are identical to a serial load.
+    
+    Args:
+        joined_paths: A list of paths to the ".wav" files to load.
+        
+        pipeline (optional): The PreprocessPipeline to apply, defaults to None
+        which leaves the samples as they were read.
+        
+        workers (optional): The number of workers, see map_in_pool.  Defaults
+        to 1, loading serially as a single batch.
+        
+        pool (optional): "process" or "thread", defaults to "process".
+        
+    Returns:
+        A list of (name, wav_array) tuples in the same order as the paths.
+    """
+    if len(joined_paths) == 0:
+        return list()
+    batches = 1 if workers == 1 else (workers or os.cpu_count() or 1)
+    size = -(-len(joined_paths) // batches)
+    jobs = [(joined_paths[i:i + size], pipeline) for i in range(0, len(joined_paths), size)]
+    results = list()
+    for batch in map_in_pool(process_wav_files, jobs, workers, pool):
+        results.extend(batch)
+    return results
+
+
+def sample_cache_path(directory):
+    """
+    Gets the default path of the preprocessed sample cache for a directory of
+    samples, which is stored alongside the samples themselves.
+    
+    Args:
+        directory: The directory of samples.
+        
+    Returns:
+        The path to the sample cache file.
+    """
+    return os.path.join(directory, SAMPLE_CACHE_FILENAME)
+
+
+def _read_sample_cache(cache_file):
+    """
+    Reads a sample cache written by _write_sample_cache.
+    
+    Returns:
+        entries, arrays: The cache's file entries keyed by filename and a dict
+        of the cached arrays keyed by filename.  Both are empty if the cache
+        is missing or unreadable.
+    """
+    if cache_file is None or not os.path.exists(cache_file):
+        return dict(), dict()
+    
+    try:
+        with np.load(cache_file, allow_pickle=False) as cache:
+            meta = json.loads(str(cache["meta"]))
+            if meta.get("version") != SAMPLE_CACHE_VERSION:
+                return dict(), dict()
+            entries = meta["files"]
+            arrays = {file: cache[entry["array"]] for file, entry in entries.items()}
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Could not read sample cache %s: %s", cache_file, e)
+        return dict(), dict()
+    
+    return entries, arrays
+
+
+def _write_sample_cache(cache_file, entries, arrays):
+    """
+    Writes the preprocessed samples to a single ".npz" cache file along with
+    the key each of them was produced under.  The cache is replaced 
+    atomically; failures to write are reported and otherwise ignored.
+    """
+    stored = dict()
+    meta = {"version": SAMPLE_CACHE_VERSION, "files": dict()}
+    for i, (file, entry) in enumerate(entries.items()):
+        entry = dict(entry, array="clip_{0}".format(i))
+        meta["files"][file] = entry
+        stored[entry["array"]] = arrays[file]
+    
+    #Samples loading in several processes or threads at once each write their own temporary file
+    tmp_file = "{0}.{1}-{2}.tmp".format(cache_file, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_file, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **stored)
+        os.replace(tmp_file, cache_file)
+        logger.info("Wrote sample cache %s", cache_file)
+    except OSError as e:
+        logger.warning("Could not write sample cache %s: %s", cache_file, e)
+
+
+def load_samples(directory, threshold=300, cutoff=5000, order=6, 
+                 use_cache=True, cache_file=None, workers=1, pool="process",
+                 pipeline=None, target_fs=None):
     """
     Loads the allophone samples from the provided directory.
     These are stored in a dict keyed by filename (minus .wav) as "int16"
@@ -104,33 +528,332 @@ def load_samples(directory):
     run through a lowpass filter (Fc 5000Hz).  All ".wav" files in the 
     directory are loaded.
     
+    The processed samples are kept in a cache file next to the samples.  Each
+    cached sample is keyed by its size and modification time along with the 
+    preprocessing settings, so later loads only re-process files which have 
+    changed.
+    
     Args:
         directory: The directory to search for samples.
         
+        threshold (optional): The trim_silence threshold, defaults to 300.
+        
+        cutoff (optional): The lowpass cutoff in Hz, defaults to 5000.
+        
+        order (optional): The lowpass filter order, defaults to 6.
+        
+        use_cache (optional): Whether to read and update the sample cache,
+        defaults to True.
+        
+        cache_file (optional): The cache file to use, defaults to the one 
+        given by sample_cache_path for the directory.
+        
+        workers (optional): The number of workers used to read and process
+        the samples, see map_in_pool.  Defaults to 1, loading serially.
+        
+        pool (optional): "process" or "thread", the kind of pool to use when
+        workers is not 1.  Defaults to "process".
+        
+        pipeline (optional): A PreprocessPipeline to use in place of the 
+        threshold, cutoff, order and target_fs settings.  Defaults to None.
+        
+        target_fs (optional): The sample frequency in Hz to resample every
+        sample to, defaults to None which leaves each at its own rate.
+        
     Returns:
         allophones: A dict of the loaded allophone samples, keyed by filename
         with a value of the loaded samples in a NumPy array.
     
     """
+    if pipeline is None:
+        pipeline = PreprocessPipeline(threshold, cutoff, order, target_fs=target_fs)
+    if not use_cache:
+        cache_file = None
+    elif cache_file is None:
+        cache_file = sample_cache_path(directory)
+    
+    cached_entries, cached_arrays = _read_sample_cache(cache_file)
+    entries = dict()
+    arrays = dict()
     allophones = dict()
+    changed = len(cached_entries) == 0
+    to_process = list()
     
     for file in os.listdir(directory):
         if file.endswith(".wav"):
             joined_path = os.path.join(directory, file)
-            p = Path(joined_path)
-            allo_name = p.resolve().stem.strip()
-            print("Loading file: {0}".format(p))
+            stat = os.stat(joined_path)
+            entry = dict(pipeline.settings(), mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            entries[file] = entry
             
-            fs, wav_array = wv.read(joined_path)
-            print("{0} with {1} samples at {2}".format(allo_name, len(wav_array), fs))
-            wav_array = trim_silence(wav_array, threshold=300)
-            wav_array = butter_lowpass_filter(wav_array, 5000, fs, order=6)
-            wav_array = wav_array.astype("int16")
-            allophones[allo_name] = wav_array
+            cached = cached_entries.get(file)
+            if cached is not None and all(cached.get(k) == v for k, v in entry.items()):
+                entry["name"] = cached["name"]
+                arrays[file] = cached_arrays[file]
+            else:
+                to_process.append(file)
+    
+    if len(to_process) > 0:
+        changed = True
+        paths = [os.path.join(directory, file) for file in to_process]
+        for file, (allo_name, wav_array) in zip(to_process, load_wav_files(paths, pipeline, workers, pool)):
+            entries[file]["name"] = allo_name
+            arrays[file] = wav_array
+    
+    #Keep the directory listing order regardless of where each clip came from
+    for file, entry in entries.items():
+        allophones[entry["name"]] = arrays[file]
+    
+    if cache_file is not None and (changed or len(entries) != len(cached_entries)):
+        _write_sample_cache(cache_file, entries, arrays)
             
     return allophones
 
 
+def _align(pos, alignment=8):
+    return (pos + alignment - 1) // alignment * alignment
+
+
+class SampleBank(Mapping):
+    
+    """
+    A voice's samples packed end to end into one contiguous "int16" buffer,
+    with a table of each sample's offset and length into it.  Looking up a 
+    sample gives a view of its slice of the buffer, so the bank behaves like 
+    the dict returned by load_samples without holding a separate array for 
+    every clip.
+    
+    A bank can be saved to a file and memory-mapped back with open, which 
+    makes no copies: every process which opens the same file shares one copy
+    of the samples in the OS page cache.  Banks opened from a file are 
+    pickled by path, so worker processes map the file rather than receiving 
+    a copy of the samples.
+    
+    The file holds a header (magic, sample frequency, sample count and the 
+    size of the name block), the sample names as NUL-separated UTF-8, the 
+    "<u8" start offset of each sample plus the end of the last, then the 
+    "<i2" samples.  The offset table and samples are 8-byte aligned.
+    
+    Args:
+        buffer: A 1D "int16" NumPy array of all the samples end to end.
+        
+        names: A list of the sample names, in buffer order.
+        
+        offsets: A sequence of the start offset of each sample in buffer,
+        followed by the end offset of the last.
+        
+        fs (optional): The sample frequency (in Hz) of the samples, defaults to
+        44100 Hz.
+        
+        path (optional): The file the bank was opened from, defaults to None.
+        
+    Attributes:
+        buffer: The contiguous buffer of samples.
+        
+        table: A dict of (offset, length) tuples into buffer, keyed by sample
+        name.
+        
+        fs: The sample frequency of the samples.
+        
+        path: The file the bank was opened from, or None if it is in memory.
+    """
+    
+    def __init__(self, buffer, names, offsets, fs=DEFAULT_FS, path=None):
+        self.buffer = buffer
+        self.fs = fs
+        self.path = path
+        self._mm = None
+        self.table = {name: (int(offsets[i]), int(offsets[i + 1] - offsets[i])) 
+                      for i, name in enumerate(names)}
+        
+        
+    @classmethod
+    def pack(cls, sounds, fs=DEFAULT_FS):
+        """
+        Packs samples into a new bank in memory, in a single allocation.
+        
+        Args:
+            sounds: A dict (or other mapping) of NumPy arrays keyed by sample
+            name, such as from load_samples.
+            
+            fs (optional): The sample frequency (in Hz) of the samples, 
+            defaults to 44100 Hz.
+            
+        Returns:
+            The SampleBank.
+        """
+        names = list(sounds)
+        offsets = np.zeros(len(names) + 1, dtype="int64")
+        np.cumsum([len(sounds[name]) for name in names], out=offsets[1:])
+        buffer = join_clips([np.asarray(sounds[name], dtype="int16") for name in names])
+        return cls(buffer, names, offsets, fs)
+    
+    
+    @classmethod
+    def open(cls, bank_file_path):
+        """
+        Memory-maps a bank saved with save, without copying the samples.
+        
+        Args:
+            bank_file_path: The path to the bank file.
+            
+        Raises:
+            ValueError if the file is not a sample bank.
+            
+        Returns:
+            The SampleBank, whose buffer is a read-only view of the file.
+        """
+        with open(bank_file_path, "rb") as bank_file:
+            mm = mmap.mmap(bank_file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic, fs, count, names_bytes = SAMPLE_BANK_HEADER.unpack_from(mm, 0)
+        if magic != SAMPLE_BANK_MAGIC:
+            mm.close()
+            raise ValueError("{0} is not a sample bank".format(bank_file_path))
+        
+        pos = SAMPLE_BANK_HEADER.size
+        names = mm[pos:pos + names_bytes].decode("utf-8").split("\0") if count > 0 else list()
+        pos = _align(pos + names_bytes)
+        offsets = np.frombuffer(mm, dtype="<u8", count=count + 1, offset=pos)
+        pos += offsets.nbytes
+        buffer = np.frombuffer(mm, dtype="<i2", count=int(offsets[-1]), offset=pos)
+        bank = cls(buffer, names, offsets, fs, path=bank_file_path)
+        bank._mm = mm
+        return bank
+    
+    
+    def save(self, bank_file_path):
+        """
+        Saves the bank to a file which open can memory-map.  The file is 
+        written to a temporary file first and then moved into place, so 
+        processes which have the old file mapped are unaffected.
+        
+        Args:
+            bank_file_path: The path to write the bank to.
+        """
+        names = list(self.table)
+        name_block = "\0".join(names).encode("utf-8")
+        offsets = np.zeros(len(names) + 1, dtype="<u8")
+        end = 0
+        for i, name in enumerate(names):
+            offsets[i] = self.table[name][0]
+            end = max(end, self.table[name][0] + self.table[name][1])
+        offsets[-1] = end
+        
+        header = SAMPLE_BANK_HEADER.pack(SAMPLE_BANK_MAGIC, self.fs, len(names), len(name_block))
+        pos = len(header) + len(name_block)
+        tmp_path = "{0}.{1}.tmp".format(bank_file_path, os.getpid())
+        with open(tmp_path, "wb") as bank_file:
+            bank_file.write(header)
+            bank_file.write(name_block)
+            bank_file.write(b"\0" * (_align(pos) - pos))
+            bank_file.write(offsets.tobytes())
+            bank_file.write(np.asarray(self.buffer[:end], dtype="<i2").tobytes())
+        os.replace(tmp_path, bank_file_path)
+        logger.info("Wrote sample bank %s with %d samples", bank_file_path, len(names))
+        
+        
+    @staticmethod
+    def is_bank_file(path):
+        """
+        Checks whether a file is a sample bank saved with save.
+        
+        Args:
+            path: The path of the file to check.
+            
+        Returns:
+            True if the file starts with the sample bank magic.
+        """
+        try:
+            with open(path, "rb") as bank_file:
+                return bank_file.read(len(SAMPLE_BANK_MAGIC)) == SAMPLE_BANK_MAGIC
+        except OSError:
+            return False
+        
+        
+    @property
+    def mapped(self):
+        """
+        True if the bank is memory-mapped from a file, False if it is in 
+        memory.
+        """
+        return self._mm is not None
+    
+    
+    def __getitem__(self, name):
+        offset, length = self.table[name]
+        return self.buffer[offset:offset + length]
+    
+    
+    def __iter__(self):
+        return iter(self.table)
+    
+    
+    def __len__(self):
+        return len(self.table)
+    
+    
+    def __reduce__(self):
+        if self.path is not None:
+            return (SampleBank.open, (self.path,))
+        names = list(self.table)
+        offsets = [self.table[name][0] for name in names] + [len(self.buffer)]
+        return (SampleBank, (self.buffer, names, offsets, self.fs))
+    
+    
+    def close(self):
+        """
+        Unmaps the bank's file.  Sample views taken from the bank must no 
+        longer be in use.
+        """
+        if self._mm is not None:
+            self.buffer = None
+            self.table = dict()
+            self._mm.close()
+            self._mm = None
+
+
+def load_sample_bank(sample_path, fs=DEFAULT_FS, pipeline=None, workers=1, pool="process"):
+    """
+    Loads a voice's samples into a SampleBank.  sample_path can either be a
+    directory of ".wav" samples, which are loaded with load_samples and 
+    packed into a bank in memory, or a sample bank file saved with 
+    SampleBank.save, which is memory-mapped without copying.  A bank file at
+    a different sample frequency from fs is resampled into memory.
+    
+    Args:
+        sample_path: The directory of samples or the sample bank file.
+        
+        fs (optional): The sample frequency (in Hz) the samples should be at,
+        defaults to 44100 Hz.
+        
+        pipeline (optional): The PreprocessPipeline for samples loaded from a
+        directory, see load_samples.  Banks are saved already processed, so 
+        it does not apply to them.  Defaults to None.
+        
+        workers (optional): The number of workers used to load samples from a
+        directory, defaults to 1.
+        
+        pool (optional): "process" or "thread", defaults to "process".
+        
+    Returns:
+        The SampleBank.
+    """
+    if not os.path.isfile(sample_path):
+        sounds = load_samples(sample_path, workers=workers, pool=pool, pipeline=pipeline)
+        return SampleBank.pack(sounds, fs)
+    
+    bank = SampleBank.open(sample_path)
+    logger.info("Mapped sample bank %s with %d samples", sample_path, len(bank))
+    if bank.fs != fs:
+        logger.info("Resampling sample bank from %d Hz to %d Hz", bank.fs, fs)
+        resampler = PreprocessPipeline(threshold=None, cutoff=None, target_fs=fs)
+        names = list(bank)
+        clips = resampler.process([(bank[name], bank.fs) for name in names])
+        bank = SampleBank.pack(dict(zip(names, clips)), fs)
+    return bank
+
+
 def load_cmu_dict(dict_file_path):
     """
     Load the CMU Sphinx Dictionary of allophones for words.  Comment lines 
@@ -148,7 +871,7 @@ def load_cmu_dict(dict_file_path):
     cmu_dict = dict()    
     
     with open(dict_file_path, "r") as dict_file:
-        print("Loading Dictionary")
+        logger.info("Loading dictionary %s", dict_file_path)
         
         for line in dict_file:
             line = line.strip()
@@ -158,111 +881,2776 @@ def load_cmu_dict(dict_file_path):
             word, phones = line.split("\t")
             cmu_dict[word] = phones.strip()
                 
-        print("Done")
+        logger.info("Loaded %d words", len(cmu_dict))
         
     return cmu_dict
 
 
-def load_allophone_map(phones_file_path):  
+def cmu_index_path(dict_file_path):
     """
-    Loads a configuration file of sound mappings.  Each line should contain a
-    comma-delimited pair where the first entry is one of the phones used in 
-    the CMU Allophone Dictionary, and the second entry is the name of the sound
-    it should be mapped to.
+    Gets the default path of the compiled index for a CMU dictionary file,
+    which lives next to the text dictionary with an ".idx" extension.
     
     Args:
-        phones_file_path: The path to the mapping file to load.
+        dict_file_path: The path to the text dictionary file.
         
     Returns:
-        A dict of CMU Phones to the Mapped Phones as strings.
+        The path to the compiled index for that dictionary.
     """
-    allo_map = dict()
+    return os.path.splitext(dict_file_path)[0] + ".idx"
+
+
+def ngram_cache_path(dict_file_path):
+    """
+    Gets the default path of the file recording the runs chosen for each 
+    voice's NgramClipCache, which lives next to the text dictionary with an 
+    ".ngrams.json" extension.
     
-    with open(phones_file_path, "r") as phones_file:
-        print("Loading Dictionary Allophones")
+    Args:
+        dict_file_path: The path to the text dictionary file.
+        
+    Returns:
+        The path to the n-gram runs file for that dictionary.
+    """
+    return os.path.splitext(dict_file_path)[0] + ".ngrams.json"
+
+
+def _read_ngram_runs(runs_file, key):
+    """
+    Reads the runs and coverage recorded under key by _write_ngram_runs.
+    
+    Returns:
+        The entry as a dict of "runs" (lists of sample names) and "coverage",
+        or None if there is none or the file is unreadable.
+    """
+    if not os.path.exists(runs_file):
+        return None
+    try:
+        with open(runs_file, "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != NGRAM_RUNS_VERSION:
+            return None
+        return meta["entries"].get(key)
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        logger.warning("Could not read n-gram runs %s: %s", runs_file, e)
+        return None
+
+
+def _write_ngram_runs(runs_file, key, entry):
+    """
+    Records the runs and coverage of an n-gram cache under key, keeping the
+    most recent entries for other voices and budgets.  The file is replaced 
+    atomically; failures to write are reported and otherwise ignored.
+    """
+    entries = OrderedDict()
+    try:
+        with open(runs_file, "r") as f:
+            meta = json.load(f, object_pairs_hook=OrderedDict)
+        if meta.get("version") == NGRAM_RUNS_VERSION:
+            entries = meta["entries"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    entries.pop(key, None)
+    entries[key] = entry
+    while len(entries) > NGRAM_RUNS_MAX_ENTRIES:
+        entries.popitem(last=False)
+    
+    #Voices loading in several processes or threads at once each write their own temporary file
+    tmp_file = "{0}.{1}-{2}.tmp".format(runs_file, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump({"version": NGRAM_RUNS_VERSION, "entries": entries}, f)
+        os.replace(tmp_file, runs_file)
+        logger.info("Wrote n-gram runs %s", runs_file)
+    except OSError as e:
+        logger.warning("Could not write n-gram runs %s: %s", runs_file, e)
+
+
+def pack_cmu_dict(cmu_dict, source_size=0, source_mtime_ns=0):
+    """
+    Packs a dictionary of words to phones into the compact binary layout 
+    used by CompiledCMUDict.  This holds a header, a table of phone names, a 
+    sorted word table (offsets into a blob of ASCII words) and a parallel 
+    table of offsets into a blob of one-byte phone IDs.  Phone IDs follow 
+    SPHINX_PHONES, with any other phones numbered after them.
+    
+    Args:
+        cmu_dict: A dict of words (all caps) to space-delimited phone strings,
+        as returned by load_cmu_dict.
+        
+        source_size (optional): The size of the text dictionary the words
+        came from, recorded to detect stale indexes.
+        
+        source_mtime_ns (optional): The modification time of the text
+        dictionary the words came from, recorded to detect stale indexes.
+        
+    Raises:
+        ValueError if there are more than 255 distinct phones.
+        
+    Returns:
+        The packed dictionary as bytes.
+    """
+    phone_ids = {phone: i for i, phone in enumerate(SPHINX_PHONES)}
+    entries = list()
+    for word, phones in cmu_dict.items():
+        phones = phones.split()
+        try:
+            ids = bytes([phone_ids[phone] for phone in phones])
+        except KeyError:
+            for phone in phones:
+                phone_ids.setdefault(phone, len(phone_ids))
+            if len(phone_ids) > 255:
+                raise ValueError("Too many distinct phones to compile: {0}".format(len(phone_ids)))
+            ids = bytes([phone_ids[phone] for phone in phones])
+        entries.append((word.encode("ascii"), ids))
+    entries.sort()
+    
+    phone_names = sorted(phone_ids, key=phone_ids.get)
+    word_offsets = np.zeros(len(entries) + 1, dtype="<u4")
+    phone_offsets = np.zeros(len(entries) + 1, dtype="<u4")
+    word_offsets[1:] = np.cumsum([len(w) for w, _ in entries])
+    phone_offsets[1:] = np.cumsum([len(p) for _, p in entries])
+    
+    parts = [CMU_INDEX_HEADER.pack(CMU_INDEX_MAGIC, source_size, source_mtime_ns,
+                                   len(entries), len(phone_names))]
+    parts.extend(name.encode("ascii").ljust(CMU_INDEX_PHONE_WIDTH, b"\0") for name in phone_names)
+    parts.append(word_offsets.tobytes())
+    parts.append(phone_offsets.tobytes())
+    parts.extend(w for w, _ in entries)
+    parts.extend(p for _, p in entries)
+    return b"".join(parts)
+
+
+def compile_cmu_dict(dict_file_path, index_file_path=None):
+    """
+    Compiles the text CMU Sphinx Dictionary into a compact binary index that
+    can be memory-mapped by CompiledCMUDict, see pack_cmu_dict for the 
+    layout.  This is a one-time step; the index records the size and 
+    modification time of the source dictionary so that a stale index can be
+    detected and ignored.
+    
+    Args:
+        dict_file_path: The path to the text dictionary file to compile.
+        
+        index_file_path (optional): Where to write the index, defaults to
+        the dictionary path with an ".idx" extension.
+        
+    Returns:
+        The path of the written index file.
+    """
+    if index_file_path is None:
+        index_file_path = cmu_index_path(dict_file_path)
+    
+    cmu_dict = load_cmu_dict(dict_file_path)
+    stat = os.stat(dict_file_path)
+    
+    logger.info("Compiling dictionary to %s", index_file_path)
+    _write_cmu_index(pack_cmu_dict(cmu_dict, stat.st_size, stat.st_mtime_ns), index_file_path)
+    logger.info("Compiled %d words", len(cmu_dict))
+    
+    return index_file_path
+
+
+def _write_cmu_index(packed, index_file_path):
+    """
+    Writes a packed dictionary to an index file, via a temporary file so 
+    that other processes never map a partially written index.
+    """
+    tmp_file = "{0}.{1}.tmp".format(index_file_path, os.getpid())
+    try:
+        with open(tmp_file, "wb") as index_file:
+            index_file.write(packed)
+        os.replace(tmp_file, index_file_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_file)
+        raise
+
+
+class CompiledCMUDict(Mapping):
+    """
+    A read-only view of a packed dictionary, normally a memory-mapped index
+    written by compile_cmu_dict.  Words are looked up lazily with a binary 
+    search over the sorted word table, so opening the index costs a single 
+    mmap no matter how large the dictionary is.  Behaves like the dict 
+    returned by load_cmu_dict: words (all caps) map to space-delimited phone
+    strings.  Pronunciations are stored as one-byte phone IDs indexing 
+    phone_names, and can be read without conversion through phone_ids.
+    
+    Args:
+        index_file_path: The path to the compiled index to open.
+        
+        packed (optional): Packed dictionary bytes from pack_cmu_dict to use
+        instead of opening a file.  Defaults to None.
+        
+    Raises:
+        ValueError if the file is not a compiled dictionary index.
+        
+    Attributes:
+        phone_names: A list of the phone names, indexed by phone ID.
+    """
+    
+    def __init__(self, index_file_path, packed=None):
+        self.index_file_path = index_file_path
+        if packed is not None:
+            self._mm = packed
+        else:
+            with open(index_file_path, "rb") as index_file:
+                self._mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        (magic, self.source_size, self.source_mtime_ns, 
+         self._count, phone_count) = CMU_INDEX_HEADER.unpack_from(self._mm, 0)
+        if magic != CMU_INDEX_MAGIC:
+            self.close()
+            raise ValueError("{0} is not a compiled dictionary index".format(index_file_path))
+        
+        pos = CMU_INDEX_HEADER.size
+        names = np.frombuffer(self._mm, dtype="S{0}".format(CMU_INDEX_PHONE_WIDTH), 
+                              count=phone_count, offset=pos)
+        self.phone_names = [n.decode("ascii") for n in names]
+        del names
+        pos += phone_count * CMU_INDEX_PHONE_WIDTH
+        self._word_offsets = np.frombuffer(self._mm, dtype="<u4", 
+                                           count=self._count + 1, offset=pos)
+        pos += self._word_offsets.nbytes
+        self._phone_offsets = np.frombuffer(self._mm, dtype="<u4", 
+                                            count=self._count + 1, offset=pos)
+        pos += self._phone_offsets.nbytes
+        self._words_start = pos
+        self._phones_start = pos + int(self._word_offsets[-1])
+        self._digest = None
+        
+        
+    @classmethod
+    def from_text(cls, dict_file_path):
+        """
+        Parses a text dictionary with load_cmu_dict and packs it in memory,
+        for when there is no compiled index to map.
+        
+        Args:
+            dict_file_path: The path to the text dictionary file.
+            
+        Returns:
+            A CompiledCMUDict holding the packed dictionary.
+        """
+        stat = os.stat(dict_file_path)
+        packed = pack_cmu_dict(load_cmu_dict(dict_file_path), stat.st_size, stat.st_mtime_ns)
+        return cls(dict_file_path, packed=packed)
+        
+        
+    @property
+    def mapped(self):
+        """
+        True if the dictionary is memory-mapped from an index file, False if
+        it is packed in memory.
+        """
+        return isinstance(self._mm, mmap.mmap)
+    
+    
+    def digest(self):
+        """
+        Gets a digest of the words and pronunciations in this dictionary, 
+        which is the same wherever the dictionary was compiled from and 
+        whether or not it is mapped from an index.
+        
+        Returns:
+            The digest as a hex string.
+        """
+        if self._digest is None:
+            end = self._phones_start + int(self._phone_offsets[-1])
+            with memoryview(self._mm) as view, view[CMU_INDEX_HEADER.size:end] as body:
+                self._digest = hashlib.sha1(body).hexdigest()
+        return self._digest
+    
+    
+    def is_stale(self, dict_file_path):
+        """
+        Checks whether this index was compiled from a different version of 
+        the text dictionary than the one currently on disk.
+        
+        Args:
+            dict_file_path: The path to the text dictionary file.
+            
+        Returns:
+            True if the text dictionary has changed since compilation.
+        """
+        stat = os.stat(dict_file_path)
+        return (stat.st_size != self.source_size or 
+                stat.st_mtime_ns != self.source_mtime_ns)
+        
+        
+    def _word_at(self, i):
+        start = self._words_start + int(self._word_offsets[i])
+        stop = self._words_start + int(self._word_offsets[i + 1])
+        return self._mm[start:stop]
+    
+    
+    def _find(self, word):
+        try:
+            key = word.encode("ascii")
+        except (AttributeError, UnicodeEncodeError):
+            return -1
+        
+        #Binary search over the sorted word table
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._word_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._word_at(lo) == key:
+            return lo
+        return -1
+    
+    
+    def phone_ids(self, word):
+        """
+        Gets the phone IDs making up the given word without copying them.
+        
+        Args:
+            word (str): The word (all caps) to look up.
+            
+        Raises:
+            KeyError if the word is not in the dictionary.
+            
+        Returns:
+            A read-only "uint8" NumPy array of IDs indexing phone_names.
+        """
+        i = self._find(word)
+        if i < 0:
+            raise KeyError(word)
+        start = self._phones_start + int(self._phone_offsets[i])
+        stop = self._phones_start + int(self._phone_offsets[i + 1])
+        return np.frombuffer(self._mm, dtype="uint8", count=stop - start, offset=start)
+        
+        
+    def pronunciations(self):
+        """
+        Gets the phone IDs of every word at once without copying them, for 
+        analysing the whole dictionary.
+        
+        Returns:
+            A tuple of a read-only "uint8" NumPy array of the phone IDs of 
+            every word one after another, in word order, and a "uint32" 
+            NumPy array of the start of each word's IDs in it, with the end 
+            of the last word appended.
+        """
+        count = int(self._phone_offsets[-1])
+        return (np.frombuffer(self._mm, dtype="uint8", count=count, offset=self._phones_start),
+                self._phone_offsets)
+        
+        
+    def phones(self, word):
+        """
+        Gets the phones making up the given word as a list of strings.
+        
+        Args:
+            word (str): The word (all caps) to look up.
+            
+        Raises:
+            KeyError if the word is not in the dictionary.
+            
+        Returns:
+            A list of the phone names for the word.
+        """
+        i = self._find(word)
+        if i < 0:
+            raise KeyError(word)
+        start = self._phones_start + int(self._phone_offsets[i])
+        stop = self._phones_start + int(self._phone_offsets[i + 1])
+        return [self.phone_names[p] for p in self._mm[start:stop]]
+        
+        
+    def __getitem__(self, word):
+        return " ".join(self.phones(word))
+    
+    
+    def __contains__(self, word):
+        return self._find(word) >= 0
+    
+    
+    def __len__(self):
+        return self._count
+    
+    
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._word_at(i).decode("ascii")
+            
+            
+    def close(self):
+        """
+        Releases the memory map backing this dictionary.  Arrays returned by
+        phone_ids must no longer be in use.
+        """
+        self._word_offsets = None
+        self._phone_offsets = None
+        if self.mapped:
+            self._mm.close()
+
+
+def cmu_dict_digest(cmu_dict):
+    """
+    Gets a digest of the words and pronunciations of a dictionary, either a
+    CompiledCMUDict or a dict as from load_cmu_dict.
+    
+    Args:
+        cmu_dict: The dictionary to digest.
+        
+    Returns:
+        The digest as a hex string.
+    """
+    if isinstance(cmu_dict, CompiledCMUDict):
+        return cmu_dict.digest()
+    h = hashlib.sha1()
+    for word, phones in sorted(cmu_dict.items()):
+        h.update("{0}={1};".format(word, phones).encode("utf-8"))
+    return h.hexdigest()
+
+
+def open_cmu_dict(dict_file_path, index_file_path=None, write_index=True):
+    """
+    Opens the CMU Sphinx Dictionary, preferring the compiled index produced 
+    by compile_cmu_dict.  Falls back to parsing the text dictionary and 
+    packing it when the index is missing, unreadable or stale, in which case
+    the packed dictionary is written out as the index so that the parsing is
+    only paid for once.  Failing to write the index is reported and 
+    otherwise ignored.
+    
+    Args:
+        dict_file_path: The path to the text dictionary file.
+        
+        index_file_path (optional): The path to the compiled index, defaults
+        to the dictionary path with an ".idx" extension.
+        
+        write_index (optional): If False, never write the index, keeping the
+        packed dictionary in memory instead.  Defaults to True.
+        
+    Returns:
+        A CompiledCMUDict, memory-mapped if a current index exists.
+    """
+    if index_file_path is None:
+        index_file_path = cmu_index_path(dict_file_path)
+    
+    if os.path.exists(index_file_path):
+        try:
+            compiled = CompiledCMUDict(index_file_path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Could not open dictionary index %s: %s", index_file_path, e)
+        else:
+            if not os.path.exists(dict_file_path) or not compiled.is_stale(dict_file_path):
+                logger.info("Using dictionary index %s", index_file_path)
+                return compiled
+            logger.info("Dictionary index %s is stale", index_file_path)
+            compiled.close()
+    
+    stat = os.stat(dict_file_path)
+    packed = pack_cmu_dict(load_cmu_dict(dict_file_path), stat.st_size, stat.st_mtime_ns)
+    if not write_index:
+        return CompiledCMUDict(dict_file_path, packed=packed)
+    try:
+        _write_cmu_index(packed, index_file_path)
+    except OSError as e:
+        logger.warning("Could not write dictionary index %s: %s", index_file_path, e)
+        return CompiledCMUDict(dict_file_path, packed=packed)
+    logger.info("Wrote dictionary index %s", index_file_path)
+    return CompiledCMUDict(index_file_path)
+
+
+def shared_cmu_dict(dict_file_path, index_file_path=None, compile_index=False):
+    """
+    Gets the CMU Sphinx Dictionary shared by every Speakophone in this 
+    process which uses the same dictionary file, opening it on first use.
+    The dictionary is read-only, so one copy can serve any number of voices.
+    
+    Sharing also extends across processes when the dictionary is compiled:
+    the index is memory-mapped read-only, so every process maps the same 
+    pages of the operating system's file cache instead of holding its own 
+    copy.  Forked worker processes also inherit the dictionary.
+    
+    Args:
+        dict_file_path: The path to the text dictionary file.
+        
+        index_file_path (optional): The path to the compiled index, defaults
+        to the dictionary path with an ".idx" extension.
+        
+        compile_index (optional): If True, compile the index first when it is 
+        missing or stale so that it can be shared between processes.  
+        Defaults to False.
+        
+    Returns:
+        The shared dictionary, see open_cmu_dict.
+    """
+    if index_file_path is None:
+        index_file_path = cmu_index_path(dict_file_path)
+    key = (os.path.abspath(dict_file_path), os.path.abspath(index_file_path))
+    
+    with _shared_dicts_lock:
+        cmu_dict = _shared_dicts.get(key)
+        if cmu_dict is None:
+            cmu_dict = open_cmu_dict(dict_file_path, index_file_path)
+            if compile_index and not cmu_dict.mapped:
+                try:
+                    compile_cmu_dict(dict_file_path, index_file_path)
+                    cmu_dict = CompiledCMUDict(index_file_path)
+                except OSError as e:
+                    logger.warning("Could not compile dictionary index %s: %s", index_file_path, e)
+            _shared_dicts[key] = cmu_dict
+        return cmu_dict
+
+
+def clear_shared_cmu_dicts():
+    """
+    Forgets every dictionary opened by shared_cmu_dict, so that the next use
+    of each opens it afresh, e.g. after the dictionary file has changed or 
+    to time a cold start.  Voices already holding a dictionary keep it.
+    """
+    with _shared_dicts_lock:
+        _shared_dicts.clear()
+
+
+def load_allophone_map(phones_file_path):  
+    """
+    Loads a configuration file of sound mappings.  Each line should contain a
+    comma-delimited pair where the first entry is one of the phones used in 
+    the CMU Allophone Dictionary, and the second entry is the name of the sound
+    it should be mapped to.
+    
+    Args:
+        phones_file_path: The path to the mapping file to load.
+        
+    Returns:
+        A dict of CMU Phones to the Mapped Phones as strings.
+    """
+    allo_map = dict()
+    
+    with open(phones_file_path, "r") as phones_file:
+        logger.info("Loading dictionary allophones %s", phones_file_path)
         for line in phones_file:
             m = line.split(',')
             cmu_phone = m[0].strip()
             c64_phone = m[1].strip()
             
             allo_map[cmu_phone] = c64_phone
-        print("Done")
+        logger.info("Loaded %d allophone mappings", len(allo_map))
         
     return allo_map
 
 
 
-class Speakophone:
-    def __init__(self, sample_dir, dict_file_path, allo_map_file_path):
-        self.sounds = load_samples(sample_dir)
-        self.cmu_dict = load_cmu_dict(dict_file_path)
-        self.allo_map = load_allophone_map(allo_map_file_path)
-        self.interword_pad = np.zeros(4000).astype("int16")
+def join_clips(clips, out=None):
+    """
+    Joins clips of audio end to end, like np.hstack, but copies each clip 
+    directly into a single output array which may be supplied by the caller.
+    
+    Args:
+        clips: A list of NumPy arrays of samples to join, in order.
+        
+        out (optional): A "int16" NumPy array to write into, which must be at
+        least as long as all of the clips combined.  Defaults to None, 
+        allocating a new array of exactly the right size.
+        
+    Raises:
+        ValueError if out is too short to hold the clips.
+        
+    Returns:
+        The joined audio.  When out is provided this is a view of its first 
+        samples.
+    """
+    total = sum(len(c) for c in clips)
+    if out is None:
+        out = np.empty(total, dtype="int16")
+    elif len(out) < total:
+        raise ValueError("Output buffer holds {0} samples but {1} are needed".format(len(out), total))
+    
+    pos = 0
+    for c in clips:
+        out[pos:pos + len(c)] = c
+        pos += len(c)
+    return out[:total]
 
 
-    def write_sounds_test(self):
+def execute_render_plan(buffer, plan, out=None):
+    """
+    Executes a render plan from Speakophone.compile_plan, copying each of its
+    segments out of a sample buffer and into place in the output.  A segment
+    with an offset of -1 is silence.  Each segment is copied as one slice, 
+    which is much faster than gathering sample by sample with index arrays.
+    
+    Args:
+        buffer: The 1D NumPy array the plan's offsets index, e.g. a 
+        SampleBank's buffer, or a sequence of such arrays for a plan with a 
+        source column.
+        
+        plan: An (n, 2) "int64" NumPy array of the (offset, length) of each
+        segment, in order, or an (n, 3) array of the (offset, length, source)
+        of each segment, where source indexes the sequence of buffers.
+        
+        out (optional): A "int16" NumPy array to write into, which must be at
+        least as long as the plan.  Defaults to None, allocating a new array 
+        of exactly the right size.
+        
+    Raises:
+        ValueError if out is too short to hold the rendered plan.
+        
+    Returns:
+        The rendered audio.  When out is provided this is a view of its first
+        samples.
+    """
+    total = int(plan[:, 1].sum())
+    if out is None:
+        out = np.zeros(total, dtype="int16")
+        silence = False
+    elif len(out) < total:
+        raise ValueError("Output buffer holds {0} samples but {1} are needed".format(len(out), total))
+    else:
+        silence = True
+    
+    sources = buffer if plan.shape[1] > 2 else None
+    pos = 0
+    for row in plan.tolist():
+        offset, length = row[0], row[1]
+        if offset >= 0:
+            source = buffer if sources is None else sources[row[2]]
+            out[pos:pos + length] = source[offset:offset + length]
+        elif silence:
+            out[pos:pos + length] = 0
+        pos += length
+    return out[:total]
+
+
+def execute_render_plans(buffer, plans):
+    """
+    Executes many render plans at once into a single output allocation.
+    
+    Args:
+        buffer: The 1D NumPy array, or sequence of arrays, the plans' offsets
+        index, see execute_render_plan.
+        
+        plans: A list of render plans, see execute_render_plan.
+        
+    Returns:
+        A list of the rendered audio for each plan, in order, as views of one
+        shared array.
+    """
+    if len(plans) == 0:
+        return list()
+    joined = execute_render_plan(buffer, np.concatenate(plans))
+    ends = np.cumsum([int(plan[:, 1].sum()) for plan in plans]).tolist()
+    return [joined[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+class SynthesisMetrics:
+    
+    """
+    Counters and per-stage timers for a Speakophone, for a service to export.
+    Stages are timed with the time context manager and counters are bumped
+    with count; both may be used from several threads at once.  The stages 
+    timed by Speakophone are "lookup" (finding the samples for the words), 
+    "gather" (executing render plans), "concatenation" (joining clips) and 
+    "output" (writing or playing audio).  Its counters include "phrases", 
+    "words", "phones" (the pieces gathered, where a run of phones from the 
+    n-gram cache counts once), "unknown_words" and the hits and misses of 
+    each cache.
+    
+    Args:
+        profile_hook (optional): A function called as profile_hook(stage, 
+        seconds) each time a stage finishes, e.g. to feed a histogram or a 
+        tracing system.  Defaults to None.
+    """
+    
+    def __init__(self, profile_hook=None):
+        self.profile_hook = profile_hook
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._timers = dict()
+        
+        
+    def count(self, name, n=1):
+        """
+        Adds n to the named counter.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+            
+            
+    @contextlib.contextmanager
+    def time(self, stage):
+        """
+        A context manager which times the code inside it as the named stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+            
+            
+    def add_time(self, stage, seconds):
+        """
+        Records one run of the named stage which took the given seconds.
+        """
+        with self._lock:
+            timer = self._timers.get(stage)
+            if timer is None:
+                self._timers[stage] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+        if self.profile_hook is not None:
+            self.profile_hook(stage, seconds)
+            
+            
+    def snapshot(self):
+        """
+        Gets the current counters and timers.
+        
+        Returns:
+            A dict with a "counters" dict of counts keyed by name, and a 
+            "timers" dict of the count, total_ms, mean_ms and max_ms of each
+            stage keyed by stage.
+        """
+        with self._lock:
+            return {"counters": dict(self._counters),
+                    "timers": {stage: {"count": count, "total_ms": total * 1000, 
+                                       "mean_ms": total * 1000 / count, "max_ms": longest * 1000}
+                               for stage, (count, total, longest) in self._timers.items()}}
+    
+    
+    def reset(self):
+        """
+        Sets every counter and timer back to zero.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+
+class WordAudioCache:
+    
+    """
+    A least-recently-used cache of rendered word audio with a memory budget.
+    Each entry maps a word (all caps) to its rendered "int16" samples.  When
+    adding an entry would take the cache over budget, the least recently used
+    entries are evicted until it fits.  Entries are stored read-only so that 
+    they can be handed out without copying, and the cache may be shared by 
+    threads.
+    
+    Args:
+        max_bytes: The memory budget for the cached audio, in bytes.
+        
+    Attributes:
+        hits: The number of lookups which found their word in the cache.
+        
+        misses: The number of lookups which did not.
+        
+        evictions: The number of entries evicted to stay within budget.
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+        
+    def get(self, word):
+        """
+        Looks up a word's rendered audio, marking it as recently used.
+        
+        Args:
+            word (str): The word (all caps) to look up.
+            
+        Returns:
+            The cached audio, or None if the word is not cached.
+        """
+        with self._lock:
+            audio = self._entries.get(word)
+            if audio is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(word)
+            return audio
+    
+    
+    def put(self, word, audio):
+        """
+        Adds a word's rendered audio to the cache, evicting least recently
+        used entries as needed.  Audio larger than the whole budget is not 
+        cached.
+        
+        Args:
+            word (str): The word (all caps) the audio is for.
+            
+            audio: The rendered NumPy array of samples, which is made 
+            read-only.
+        """
+        if audio.nbytes > self.max_bytes:
+            return
+        audio.setflags(write=False)
+        
+        with self._lock:
+            if word in self._entries:
+                self.nbytes -= self._entries.pop(word).nbytes
+            
+            while self.nbytes + audio.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+            
+            self._entries[word] = audio
+            self.nbytes += audio.nbytes
+        
+        
+    def clear(self):
+        """
+        Removes every entry from the cache.  The counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+        
+        
+    def stats(self):
+        """
+        Gets a summary of the cache's size and effectiveness.
+        
+        Returns:
+            A dict of the entry count, bytes used, budget, hits, misses, 
+            evictions and hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "bytes": self.nbytes, 
+                "max_bytes": self.max_bytes, "hits": self.hits, 
+                "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+    
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    
+    def __contains__(self, word):
+        return word in self._entries
+
+
+def frequent_sample_ngrams(sequence, offsets, max_n=3):
+    """
+    Counts the runs of 2 to max_n consecutive samples within the words of a
+    dictionary, and ranks them by the number of pieces that pre-joining them
+    would save across the dictionary.
+    
+    Args:
+        sequence: A NumPy array of the sample index of every phone of every
+        word, one word after another.
+        
+        offsets: A NumPy array of the start of each word in sequence, with 
+        the end of the last word appended.
+        
+        max_n (optional): The longest run to count, defaults to 3.
+        
+    Returns:
+        A list of (run, count) pairs, where run is a tuple of sample indexes,
+        ordered from the most pieces saved (count * (len(run) - 1)) to the 
+        least.
+    """
+    sequence = np.asarray(sequence, dtype="int64")
+    offsets = np.asarray(offsets, dtype="int64")
+    if len(sequence) == 0:
+        return list()
+    base = int(sequence.max()) + 1
+    word_of = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    
+    ranked = list()
+    for n in range(2, max_n + 1):
+        starts = np.arange(len(sequence) - n + 1)
+        starts = starts[word_of[starts] == word_of[starts + n - 1]]
+        codes = np.zeros(len(starts), dtype="int64")
+        for k in range(n):
+            codes = codes * base + sequence[starts + k]
+        codes, counts = np.unique(codes, return_counts=True)
+        for code, count in zip(codes.tolist(), counts.tolist()):
+            run = list()
+            for _ in range(n):
+                code, sample = divmod(code, base)
+                run.append(sample)
+            ranked.append((tuple(reversed(run)), count))
+    ranked.sort(key=lambda item: item[1] * (len(item[0]) - 1), reverse=True)
+    return ranked
+
+
+class NgramClipCache:
+    
+    """
+    Pre-joined clips of the runs of samples which occur most often across the
+    words of the dictionary, such as the mapped clips of frequent phone 
+    bigrams and trigrams.  Runs are taken in the order given until the memory
+    budget is spent.  A word is then covered greedily from the left by the 
+    longest cached run at each position, so far fewer pieces are gathered per
+    word.  The pre-joined clips give exactly the same audio as the samples 
+    they join.
+    
+    Args:
+        ranked: A list of (run, count) pairs from frequent_sample_ngrams, 
+        where run is a tuple of indexes into clips.
+        
+        clips: A list of the NumPy arrays of samples, indexed by sample 
+        index.
+        
+        max_bytes: The memory budget for the pre-joined clips, in bytes.
+        
+    Attributes:
+        buffer: The pre-joined clips packed one after another in a single 
+        NumPy array.
+        
+        runs: A dict from each cached run to its (offset, length) in buffer,
+        in the order they were cached.
+        
+        hits: The number of pieces covered by a cached run.
+        
+        misses: The number of pieces which were single samples.
+        
+        phones: The number of phones covered.
+        
+        covered_phones: The number of phones covered by cached runs.
+        
+        coverage: The fraction of pieces saved across the dictionary, see 
+        measure_coverage.  None until it is measured.
+    """
+    
+    def __init__(self, ranked, clips, max_bytes):
+        self.max_bytes = max_bytes
+        self.runs = OrderedDict()
+        self.max_n = 1
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.phones = 0
+        self.covered_phones = 0
+        self.coverage = None
+        self._lock = threading.Lock()
+        
+        chosen = list()
+        for run, _ in ranked:
+            length = sum(len(clips[i]) for i in run)
+            size = length * clips[run[0]].itemsize
+            if self.nbytes + size > max_bytes:
+                continue
+            self.runs[run] = (self.nbytes // clips[run[0]].itemsize, length)
+            self.max_n = max(self.max_n, len(run))
+            self.nbytes += size
+            chosen.extend(clips[i] for i in run)
+        dtype = clips[0].dtype if len(clips) > 0 else np.dtype("int16")
+        self.buffer = np.concatenate(chosen) if len(chosen) > 0 else np.zeros(0, dtype=dtype)
+        self.buffer.setflags(write=False)
+        
+        
+    def cover(self, sample_indexes, run_index, count=True):
+        """
+        Covers a word's samples greedily with the longest cached run at each 
+        position.
+        
+        Args:
+            sample_indexes: The sample index of each phone of the word.
+            
+            run_index: A dict from each cached run to the index to give for 
+            it in the result.
+            
+            count (optional): If True (the default), add to the hit counters.
+            
+        Returns:
+            A list of indexes, each either a sample index or the run_index of
+            a cached run.
+        """
+        samples = sample_indexes.tolist() if hasattr(sample_indexes, "tolist") else list(sample_indexes)
+        pieces = list()
+        hits = 0
+        covered = 0
+        i = 0
+        n = len(samples)
+        while i < n:
+            for k in range(min(self.max_n, n - i), 1, -1):
+                index = run_index.get(tuple(samples[i:i + k]))
+                if index is not None:
+                    pieces.append(index)
+                    hits += 1
+                    covered += k
+                    i += k
+                    break
+            else:
+                pieces.append(samples[i])
+                i += 1
+        if count:
+            with self._lock:
+                self.hits += hits
+                self.misses += len(pieces) - hits
+                self.phones += n
+                self.covered_phones += covered
+        return pieces
+    
+    
+    def measure_coverage(self, sequence, offsets):
+        """
+        Measures the fraction of pieces saved by covering every word of the 
+        dictionary, and stores it as coverage.
+        
+        Args:
+            sequence, offsets: The dictionary's samples as for 
+            frequent_sample_ngrams.
+            
+        Returns:
+            The coverage, from 0 (no pieces saved) towards 1.
+        """
+        run_index = {run: -1 for run in self.runs}
+        samples = np.asarray(sequence).tolist()
+        bounds = np.asarray(offsets).tolist()
+        pieces = 0
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            pieces += len(self.cover(samples[start:stop], run_index, count=False))
+        self.coverage = 1 - pieces / len(samples) if len(samples) > 0 else 0.0
+        return self.coverage
+    
+    
+    def stats(self):
+        """
+        Gets a summary of the cache's size and effectiveness.
+        
+        Returns:
+            A dict of the number of cached runs of each length, bytes used, 
+            budget, dictionary coverage, hits, misses, phones, hit rate (the
+            fraction of pieces which were cached runs) and phone coverage 
+            (the fraction of phones covered by cached runs).
+        """
+        lengths = dict()
+        for run in self.runs:
+            key = "{0}grams".format(len(run))
+            lengths[key] = lengths.get(key, 0) + 1
+        pieces = self.hits + self.misses
+        stats = {"entries": len(self.runs), "bytes": self.nbytes, 
+                 "max_bytes": self.max_bytes, "coverage": self.coverage,
+                 "hits": self.hits, "misses": self.misses, "phones": self.phones,
+                 "hit_rate": self.hits / pieces if pieces else 0.0,
+                 "phone_coverage": self.covered_phones / self.phones if self.phones else 0.0}
+        stats.update(lengths)
+        return stats
+    
+    
+    def __len__(self):
+        return len(self.runs)
+
+
+def corpus_paths(corpus_path):
+    """
+    Gets the paths of the two files making up a word corpus: the raw "int16"
+    audio and its index.
+    
+    Args:
+        corpus_path: The path prefix of the corpus.
+        
+    Returns:
+        data_path, index_path: The paths of the audio and index files.
+    """
+    return corpus_path + ".pcm", corpus_path + ".index.npz"
+
+
+def _sequence_key(names):
+    """
+    Gets a 64 bit key identifying an ordered sequence of sample names.
+    """
+    digest = hashlib.blake2b(" ".join(names).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _init_corpus_worker(sounds):
+    global _corpus_sounds
+    _corpus_sounds = sounds
+
+
+def _render_corpus_words(data_path, jobs):
+    """
+    Renders words into their place in a corpus audio file.  Runs in a corpus
+    build worker after _init_corpus_worker has provided the samples.
+    
+    Args:
+        data_path: The corpus audio file, which must already be full size.
+        
+        jobs: A list of (offset, sample names) tuples, one per word.
+        
+    Returns:
+        The number of words rendered.
+    """
+    data = np.memmap(data_path, dtype="int16", mode="r+")
+    for offset, names in jobs:
+        join_clips([_corpus_sounds[n] for n in names], data[offset:])
+    data.flush()
+    del data
+    return len(jobs)
+
+
+class WordCorpus:
+    
+    """
+    A memory-mapped corpus of pre-rendered word audio built by 
+    build_word_corpus.  All of the audio lives in one contiguous "int16" 
+    file, and each word is served as a zero-copy slice of it.
+    
+    Args:
+        corpus_path: The path prefix of the corpus, see corpus_paths.
+        
+    Attributes:
+        fingerprint: The voice_fingerprint of the Speakophone the corpus was
+        rendered with.  The corpus is only valid for that voice.
+        
+        sample_digests: A dict of the digest of each sample used, keyed by 
+        sample name, which allows incremental rebuilds.
+    """
+    
+    def __init__(self, corpus_path):
+        data_path, index_path = corpus_paths(corpus_path)
+        with np.load(index_path, allow_pickle=False) as index:
+            self.words = index["words"]
+            self.offsets = index["offsets"]
+            self.lengths = index["lengths"]
+            self.keys = index["keys"]
+            meta = json.loads(str(index["meta"]))
+        self.fingerprint = meta["fingerprint"]
+        self.sample_digests = meta["sample_digests"]
+        
+        if len(self.words) > 0:
+            self.data = np.memmap(data_path, dtype="int16", mode="r")
+        else:
+            self.data = np.zeros(0, dtype="int16")
+        
+        
+    def find(self, word):
+        """
+        Finds a word's position in the corpus index.
+        
+        Args:
+            word (str): The word (all caps) to find.
+            
+        Returns:
+            The index of the word, or -1 if it is not in the corpus.
+        """
+        try:
+            key = word.encode("ascii")
+        except UnicodeEncodeError:
+            return -1
+        i = int(np.searchsorted(self.words, key))
+        if i < len(self.words) and self.words[i] == key:
+            return i
+        return -1
+        
+        
+    def get(self, word):
+        """
+        Gets the pre-rendered audio for a word.
+        
+        Args:
+            word (str): The word (all caps) to look up.
+            
+        Returns:
+            A read-only view of the word's samples, or None if the word is
+            not in the corpus.
+        """
+        i = self.find(word)
+        if i < 0:
+            return None
+        offset = int(self.offsets[i])
+        return self.data[offset:offset + int(self.lengths[i])]
+    
+    
+    def __len__(self):
+        return len(self.words)
+    
+    
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+
+def build_word_corpus(app, corpus_path, words=None, workers=None, pool="process"):
+    """
+    Renders every word in a Speakophone's dictionary into a WordCorpus.  
+    Only words which can appear in a phrase (letters and apostrophes) and 
+    whose phones all map to loaded samples are included.  The whole 
+    dictionary is large: expect a few GB of audio for a typical voice, so a
+    list of words may be given instead.
+    
+    If a corpus already exists at corpus_path, words whose samples are all 
+    unchanged are copied across from it and only the rest are rendered.
+    Rendering is spread across a pool of workers which each write their words
+    directly into the memory-mapped output.
+    
+    Args:
+        app: The Speakophone whose voice the corpus is rendered with.
+        
+        corpus_path: The path prefix of the corpus, see corpus_paths.
+        
+        words (optional): The words to include, defaults to None for the 
+        whole dictionary.
+        
+        workers (optional): The number of workers used to render the words,
+        see map_in_pool.  Defaults to None, one per CPU.
+        
+        pool (optional): "process" or "thread", defaults to "process".
+        
+    Returns:
+        The newly built WordCorpus.
+    """
+    data_path, index_path = corpus_paths(corpus_path)
+    digests = app.sample_digests()
+    
+    if words is None:
+        words = app.cmu_dict
+    words = sorted(set(w.upper() for w in words if re.fullmatch("[A-Za-z']+", w)))
+    
+    logger.info("Planning corpus of %d words", len(words))
+    entries = list()
+    for w in words:
+        try:
+            names = tuple(app.allo_map[p] for p in app.cmu_dict[w].split(" "))
+            length = sum(len(app.sounds[n]) for n in names)
+        except KeyError:
+            continue
+        entries.append((w, names, length))
+    
+    lengths = np.array([length for _, _, length in entries], dtype="int64")
+    offsets = np.zeros(len(entries), dtype="int64")
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    keys = np.array([_sequence_key(names) for _, names, _ in entries], dtype="uint64")
+    total = int(lengths.sum())
+    
+    old = None
+    if os.path.exists(index_path) and os.path.exists(data_path):
+        try:
+            old = WordCorpus(corpus_path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Could not open existing corpus %s: %s", corpus_path, e)
+    
+    tmp_path = data_path + ".tmp"
+    data = np.memmap(tmp_path, dtype="int16", mode="w+", shape=(max(total, 1),))
+    
+    pending = list()
+    reused = 0
+    changed = set()
+    if old is not None:
+        changed = set(n for n, d in digests.items() if old.sample_digests.get(n) != d)
+    for (w, names, length), offset, key in zip(entries, offsets, keys):
+        i = old.find(w) if old is not None else -1
+        if i >= 0 and old.keys[i] == key and changed.isdisjoint(names):
+            old_offset = int(old.offsets[i])
+            data[offset:offset + length] = old.data[old_offset:old_offset + length]
+            reused += 1
+        else:
+            pending.append((int(offset), names))
+    data.flush()
+    del data
+    old = None
+    
+    logger.info("Rendering %d words, reusing %d", len(pending), reused)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunk_size = max(1, -(-len(pending) // (workers * 4)))
+    jobs = [(tmp_path, pending[i:i + chunk_size]) for i in range(0, len(pending), chunk_size)]
+    map_in_pool(_render_corpus_words, jobs, workers, pool, 
+                initializer=_init_corpus_worker, initargs=(app.sounds,))
+    
+    meta = {"fingerprint": app.voice_fingerprint(), "sample_digests": digests}
+    tmp_index = index_path + ".tmp"
+    with open(tmp_index, "wb") as f:
+        np.savez(f, words=np.array([w.encode("ascii") for w, _, _ in entries], dtype="S"),
+                 offsets=offsets, lengths=lengths, keys=keys, meta=np.array(json.dumps(meta)))
+    os.replace(tmp_path, data_path)
+    os.replace(tmp_index, index_path)
+    logger.info("Wrote corpus %s with %d words", corpus_path, len(entries))
+    
+    return WordCorpus(corpus_path)
+
+
+class PhraseCache:
+    
+    """
+    A content-addressed cache of rendered phrases on disk.  Each phrase is 
+    stored as a ".wav" file named by a key which hashes the normalized phrase
+    together with the voice it was spoken in, so a cached phrase can be read 
+    back (or copied straight to an output file) without any synthesis.  When
+    the cache grows past its size cap, the least recently used files are 
+    removed.  
+    
+    The size and order of use of the files are kept in memory, read from the
+    directory once when the cache is created, so storing a phrase does not 
+    rescan the directory.  The files' modification times are also kept up to 
+    date, so the order of use carries over to the next cache on the same 
+    directory.  Files written by other processes meanwhile are only tracked 
+    once they are read.  The cache may be shared by threads.
+    
+    Args:
+        directory: The directory to keep the cached ".wav" files in.  It is 
+        created if it does not exist.
+        
+        max_bytes: The size cap of the cache, in bytes.
+        
+        fs (optional): The sample frequency (in Hz) the phrases are stored at,
+        defaults to 44100 Hz.
+        
+    Attributes:
+        hits: The number of lookups which found their phrase in the cache.
+        
+        misses: The number of lookups which did not.
+    """
+    
+    def __init__(self, directory, max_bytes, fs=DEFAULT_FS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fs = fs
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        
+        files = list()
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".wav") and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime_ns, entry.path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._entries[path] = size
+            self.nbytes += size
+        
+        
+    @staticmethod
+    def key(words, fingerprint):
+        """
+        Computes the cache key for a phrase.
+        
+        Args:
+            words: The normalized list of words in the phrase.
+            
+            fingerprint (str): A fingerprint of everything else that affects
+            the rendered audio, such as the voice and the interword padding.
+            
+        Returns:
+            The key as a hex string.
+        """
+        text = " ".join(words) + "\0" + fingerprint
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+    
+    
+    def path(self, key):
+        """
+        Gets the path of the cached ".wav" file for a key.
+        """
+        return os.path.join(self.directory, key + ".wav")
+    
+    
+    def _touch(self, path):
+        """
+        Marks a cached file as recently used.
+        
+        Returns:
+            True if the file is cached, otherwise False.
+        """
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._forget(path)
+            return False
+        
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                return True
+        #Written by another process since the cache was created
+        self._track(path)
+        return True
+    
+    
+    def _track(self, path):
+        """
+        Records the size of a cached file as the most recently used.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            self._forget(path)
+            self._entries[path] = size
+            self.nbytes += size
+            
+            
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            
+            
+    def _forget(self, path):
+        """
+        Drops a file from the record of the cache.  Must be called holding 
+        the lock.
+        """
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self.nbytes -= size
+        
+        
+    def get(self, key):
+        """
+        Reads a cached phrase, marking it as recently used.
+        
+        Args:
+            key (str): The phrase's key.
+            
+        Returns:
+            The cached audio as a NumPy array, or None if it is not cached.
+        """
+        path = self.path(key)
+        if not self._touch(path):
+            self._count(False)
+            return None
+        try:
+            _, audio = wv.read(path)
+        except (OSError, ValueError):
+            self._count(False)
+            return None
+        self._count(True)
+        return audio
+    
+    
+    def copy_to(self, key, output_file):
+        """
+        Copies a cached phrase's ".wav" file to output_file without decoding
+        it, marking it as recently used.
+        
+        Args:
+            key (str): The phrase's key.
+            
+            output_file: The path to copy the ".wav" file to.
+            
+        Returns:
+            True if the phrase was cached and copied, otherwise False.
+        """
+        path = self.path(key)
+        if not self._touch(path):
+            self._count(False)
+            return False
+        shutil.copyfile(path, output_file)
+        self._count(True)
+        return True
+    
+    
+    def put(self, key, audio):
+        """
+        Stores a rendered phrase, then evicts least recently used phrases 
+        until the cache is back under its size cap.
+        
+        Args:
+            key (str): The phrase's key.
+            
+            audio: The rendered NumPy array of samples.
+        """
+        path = self.path(key)
+        tmp_path = "{0}.{1}-{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            wv.write(tmp_path, self.fs, audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write phrase cache file %s: %s", path, e)
+            return
+        self._track(path)
+        self.evict()
+        
+        
+    def evict(self):
+        """
+        Removes the least recently used phrases until the cache is within its
+        size cap.
+        """
+        evicted = list()
+        with self._lock:
+            while self.nbytes > self.max_bytes and len(self._entries) > 0:
+                path, size = self._entries.popitem(last=False)
+                self.nbytes -= size
+                evicted.append(path)
+        for path in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            
+            
+    def clear(self):
+        """
+        Removes every cached phrase.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".wav") and entry.is_file():
+                os.remove(entry.path)
+
+
+class AudioStreamWriter:
+    
+    """
+    Writes audio to a file, pipe or socket a chunk at a time as it is 
+    generated, so a long output never has to be held in memory all at once
+    and whatever reads it can start straight away.  The output is either a 
+    ".wav" stream, whose header is written up front, or raw little-endian 
+    PCM with no header at all.
+    
+    A ".wav" header has to give the size of the audio, which is not known 
+    until the last chunk is written.  The header is first written with the 
+    sizes set to 0xFFFFFFFF, which streaming readers treat as "until the end
+    of the stream", and if the output is seekable the real sizes are patched 
+    in when the writer is closed.
+    
+    Args:
+        output: A path to write to, or a binary file-like object such as 
+        sys.stdout.buffer or a socket's makefile("wb").  File-like objects are
+        flushed but not closed when the writer is closed.
+        
+        fs (optional): The sample frequency (in Hz) of the audio, defaults to
+        44100 Hz.
+        
+        raw (optional): If True, write raw PCM with no ".wav" header.  
+        Defaults to False.
+        
+        dtype (optional): The sample type to write, "int16" (the default) or 
+        "float32".  Chunks of any other type are converted to it.
+        
+    Attributes:
+        frames: The number of samples written so far.
+    """
+    
+    def __init__(self, output, fs=DEFAULT_FS, raw=False, dtype="int16"):
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        if self.dtype.kind not in "if":
+            raise ValueError("Cannot stream samples of type {0}".format(dtype))
+        self.fs = fs
+        self.raw = raw
+        self.frames = 0
+        self._owns_file = not hasattr(output, "write")
+        self._file = open(output, "wb") if self._owns_file else output
+        self._header_at = None
+        if not raw:
+            try:
+                self._header_at = self._file.tell() if self._file.seekable() else None
+            except (AttributeError, OSError):
+                self._header_at = None
+            self._file.write(self._header(WAV_UNKNOWN_SIZE))
+            
+            
+    def _header(self, data_bytes):
+        """
+        Builds the ".wav" header for a data chunk of data_bytes bytes.
+        """
+        width = self.dtype.itemsize
+        riff_bytes = WAV_UNKNOWN_SIZE if data_bytes == WAV_UNKNOWN_SIZE else data_bytes + WAV_HEADER.size - 8
+        return WAV_HEADER.pack(b"RIFF", riff_bytes, b"WAVE", b"fmt ", 16,
+                               1 if self.dtype.kind == "i" else 3, 1, 
+                               self.fs, self.fs * width, width, width * 8,
+                               b"data", data_bytes)
+    
+    
+    def write(self, chunk):
+        """
+        Writes a chunk of samples to the output.
+        
+        Args:
+            chunk: A NumPy array of samples.
+        """
+        chunk = np.asarray(chunk)
+        if chunk.dtype != self.dtype:
+            chunk = chunk.astype(self.dtype)
+        self._file.write(chunk.tobytes())
+        self.frames += len(chunk)
+        
+        
+    def write_chunks(self, chunks):
+        """
+        Writes every chunk from an iterable of chunks, such as the generator
+        from Speakophone.generate_audio_chunks, flushing after each so that 
+        readers receive them as soon as they are generated.
+        
+        Args:
+            chunks: An iterable of NumPy arrays of samples.
+        """
+        for chunk in chunks:
+            self.write(chunk)
+            self._file.flush()
+            
+            
+    def close(self):
+        """
+        Finishes the output, patching the ".wav" header with the real sizes 
+        if the output is seekable.
+        """
+        if self._file is None:
+            return
+        data_bytes = self.frames * self.dtype.itemsize
+        if self._header_at is not None and data_bytes + WAV_HEADER.size - 8 < WAV_UNKNOWN_SIZE:
+            end = self._file.tell()
+            self._file.seek(self._header_at)
+            self._file.write(self._header(data_bytes))
+            self._file.seek(end)
+        if self._owns_file:
+            self._file.close()
+        else:
+            self._file.flush()
+        self._file = None
+        
+        
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SoundDeviceSink:
+    
+    """
+    An audio sink which plays to the default sound device through one 
+    persistent output stream, so consecutive chunks play gaplessly instead of
+    cutting each other off as separate sd.play calls do.  The stream is 
+    opened on the first write.  Needs sounddevice.
+    
+    Args:
+        fs (optional): The sample frequency (in Hz) to play at, defaults to 
+        44100 Hz.
+    """
+    
+    def __init__(self, fs=DEFAULT_FS):
+        self.fs = fs
+        self._stream = None
+        
+        
+    def write(self, chunk):
+        """
+        Plays a chunk of samples, blocking until it has been buffered.
+        
+        Args:
+            chunk: A NumPy array of samples.
+        """
+        if self._stream is None:
+            self._stream = _sound_device().OutputStream(samplerate=self.fs, channels=1, dtype="int16")
+            self._stream.start()
+        self._stream.write(np.ascontiguousarray(chunk, dtype="int16"))
+        
+        
+    def abort(self):
+        """
+        Stops playback straight away, dropping any audio still buffered.
+        """
+        if self._stream is not None:
+            self._stream.abort()
+            self._stream.start()
+            
+            
+    def close(self):
+        """
+        Closes the output stream, if open.
+        """
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            
+            
+class NullSink:
+    
+    """
+    An audio sink which discards the audio, for running a SpeechQueue 
+    headless.  It can take as long as playback would, to stand in for a 
+    sound device in timing tests.
+    
+    Args:
+        fs (optional): The sample frequency (in Hz) of the audio, defaults to
+        44100 Hz.
+        
+        realtime (optional): If True, each write sleeps for the duration of 
+        its chunk.  Defaults to False.
+        
+    Attributes:
+        frames: The number of samples written so far.
+        
+        chunks: The number of chunks written so far.
+    """
+    
+    def __init__(self, fs=DEFAULT_FS, realtime=False):
+        self.fs = fs
+        self.realtime = realtime
+        self.frames = 0
+        self.chunks = 0
+        
+        
+    def write(self, chunk):
+        self.frames += len(chunk)
+        self.chunks += 1
+        if self.realtime:
+            time.sleep(len(chunk) / self.fs)
+            
+            
+    def abort(self):
+        pass
+    
+    
+    def close(self):
+        pass
+    
+    
+class WavFileSink(AudioStreamWriter):
+    
+    """
+    An audio sink which writes everything played to one ".wav" (or raw PCM)
+    stream, for running a SpeechQueue headless.  Takes the same arguments as
+    AudioStreamWriter.
+    """
+    
+    def write(self, chunk):
+        super().write(chunk)
+        self._file.flush()
+        
+        
+    def abort(self):
+        pass
+    
+    
+class SpeechQueue:
+    
+    """
+    Speaks phrases in the background, so the caller never waits on synthesis
+    or playback.  A producer thread synthesizes the queued phrases a word at
+    a time with Speakophone.generate_audio_chunks, up to ahead chunks in 
+    front of playback, and a consumer thread writes them to an audio sink.
+    Synthesis of the next phrase therefore overlaps playback of the current 
+    one, and phrases follow each other with no gaps or cut-offs.
+    
+    A phrase with a word missing from the dictionary is logged and skipped 
+    from that word on; the words before it will already have been spoken.
+    Any other error synthesizing a phrase is logged and the phrase skipped,
+    so the queue keeps running.
+    
+    The sink can be anything with write(chunk), abort() and close() methods:
+    SoundDeviceSink (the default) to play aloud, or NullSink or WavFileSink
+    to run headless.
+    
+    Args:
+        app: The Speakophone to speak the phrases with.  It may still be 
+        used from other threads while the queue is open, e.g. to write 
+        phrases to files.
+        
+        sink (optional): The audio sink to play to, defaults to a 
+        SoundDeviceSink at the fs of app.
+        
+        ahead (optional): The number of synthesized chunks (words) which may
+        wait for playback, defaults to 32.
+        
+    Attributes:
+        sink: The audio sink played to.
+        
+        skipped: The number of phrases which could not be fully spoken.
+    """
+    
+    def __init__(self, app, sink=None, ahead=32):
+        self.app = app
+        self.sink = sink if sink is not None else SoundDeviceSink(app.fs)
+        self.skipped = 0
+        self._phrases = queue.Queue()
+        self._chunks = queue.Queue(maxsize=max(1, ahead))
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._generation = 0
+        self._closed = False
+        self._producer = threading.Thread(target=self._produce, name="SpeechQueue-producer", daemon=True)
+        self._consumer = threading.Thread(target=self._consume, name="SpeechQueue-consumer", daemon=True)
+        self._producer.start()
+        self._consumer.start()
+        
+        
+    def say_async(self, phrase):
+        """
+        Queues a phrase to be spoken after those already queued, returning 
+        straight away.
+        
+        Args:
+            phrase (str): The phrase which should be "spoken".
+            
+        Raises:
+            RuntimeError if the queue has been closed.
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("SpeechQueue is closed")
+            self._pending += 1
+            self._phrases.put((phrase, self._generation))
+            
+            
+    def flush(self, timeout=None):
+        """
+        Waits until every queued phrase has been written to the sink.
+        
+        Args:
+            timeout (optional): The longest time to wait in seconds, defaults
+            to None, waiting for as long as it takes.
+            
+        Returns:
+            True if everything was spoken, False if the timeout ran out 
+            first.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+        
+        
+    def cancel(self):
+        """
+        Drops every queued phrase, stops the one being spoken and aborts any
+        audio buffered in the sink.  Phrases queued afterwards are spoken as
+        normal.
+        """
+        with self._cond:
+            self._generation += 1
+            self._pending = 0
+            _drain_queue(self._phrases)
+            _drain_queue(self._chunks)
+            self._cond.notify_all()
+        self.sink.abort()
+        
+        
+    @property
+    def pending(self):
+        """
+        The number of queued phrases which have not finished being spoken.
+        """
+        return self._pending
+    
+    
+    def close(self, cancel=False):
+        """
+        Stops the background threads and closes the sink.  Calling close 
+        again does nothing.
+        
+        Args:
+            cancel (optional): If True, drop anything still queued, otherwise
+            (the default) wait for it to be spoken first.
+        """
+        with self._cond:
+            if self._closed:
+                return
+        if cancel:
+            self.cancel()
+        else:
+            self.flush()
+        with self._cond:
+            self._closed = True
+            self._phrases.put(None)
+        self._producer.join()
+        self._consumer.join()
+        self.sink.close()
+        
+        
+    def _produce(self):
+        while True:
+            item = self._phrases.get()
+            if item is None:
+                self._chunks.put(None)
+                return
+            phrase, generation = item
+            try:
+                for chunk in self.app.generate_audio_chunks(phrase):
+                    if generation != self._generation:
+                        break
+                    self._chunks.put((chunk, generation))
+            except ValueError as e:
+                self.skipped += 1
+                logger.warning("Skipped \"%s\": %s", phrase, e)
+            except Exception:
+                self.skipped += 1
+                logger.exception("Could not speak %r", phrase)
+            finally:
+                #Marks the end of the phrase for flush, even if it failed
+                self._chunks.put((None, generation))
+            
+            
+    def _consume(self):
+        while True:
+            item = self._chunks.get()
+            if item is None:
+                return
+            chunk, generation = item
+            if generation != self._generation:
+                continue
+            if chunk is None:
+                with self._cond:
+                    if generation == self._generation:
+                        self._pending -= 1
+                        self._cond.notify_all()
+                continue
+            try:
+                with self.app.metrics.time("output"):
+                    self.sink.write(chunk)
+            except Exception:
+                logger.exception("Audio sink failed")
+                
+                
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, exc_type, *exc_info):
+        self.close(cancel=exc_type is not None)
+        
+        
+def _drain_queue(q):
+    """
+    Removes everything waiting in a queue.Queue without blocking.
+    """
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+
+def split_document(text, max_words=100):
+    """
+    Splits a document into chunks of whole sentences for rendering in 
+    parallel.  Sentences end with ".", "!" or "?" followed by whitespace, or
+    at a blank line between paragraphs.  A sentence of more than max_words 
+    words is split into several chunks.
+    
+    Args:
+        text (str): The document to split.
+        
+        max_words (optional): The most words in a chunk, defaults to 100.
+        
+    Returns:
+        A list of (offset, chunk) tuples in order, where offset is the index 
+        of the chunk's first character in text.  Chunks with no words are 
+        left out.
+    """
+    chunks = list()
+    start = 0
+    ends = [m.end() for m in SENTENCE_END_PATTERN.finditer(text)]
+    ends.append(len(text))
+    for end in ends:
+        words = list(re.finditer(r"\S+", text[start:end]))
+        for i in range(0, len(words), max_words):
+            chunk_start = start + words[i].start()
+            chunk_end = start + words[min(i + max_words, len(words)) - 1].end()
+            chunks.append((chunk_start, text[chunk_start:chunk_end]))
+        start = end
+    return chunks
+
+
+def _init_batch_worker(config):
+    global _batch_app
+    _batch_app = Speakophone(**config)
+
+
+def _in_batch_worker(func, *args):
+    """
+    Calls func with the voice loaded by _init_batch_worker in this worker 
+    process, followed by args.
+    """
+    return func(_batch_app, *args)
+
+
+def _batch_generate(app, phrase):
+    """
+    Generates one phrase of a batch, see Speakophone.generate_batch.
+    """
+    try:
+        return app.generate_audio(phrase), None
+    except ValueError as e:
+        return None, str(e)
+    
+    
+def _batch_document_chunk(app, text, offset):
+    """
+    Renders one chunk of a document, see Speakophone.generate_document_chunks.
+    """
+    return app.render_document_chunk(text, offset)
+    
+    
+def _batch_write(app, phrase, output_file):
+    """
+    Writes one phrase of a batch, see Speakophone.write_batch.
+    """
+    try:
+        app.write_phrase(phrase, output_file)
+        return output_file, None
+    except (ValueError, OSError) as e:
+        return None, str(e)
+
+
+class Speakophone:
+    
+    """
+    Speaks phrases by stitching together allophone samples for the phones
+    that make up each word, as given by the CMU Sphinx Dictionary.
+    
+    The samples are kept packed together in a SampleBank, which can be 
+    memory-mapped from a bank file and shared between processes.
+    
+    Args:
+        sample_dir: The directory of allophone ".wav" samples, or a sample 
+        bank file saved with SampleBank.save.
+        
+        dict_file_path: The path to the CMU Sphinx Dictionary file.
+        
+        allo_map_file_path: The path to the mapping of dictionary phones to
+        sample names.
+        
+        workers (optional): The number of workers used to load the samples,
+        see map_in_pool.  Defaults to 1, loading serially.
+        
+        pool (optional): "process" or "thread", the kind of pool used to load
+        the samples when workers is not 1.  Defaults to "process".
+        
+        word_cache_bytes (optional): The memory budget in bytes for caching
+        rendered words, see WordAudioCache.  Defaults to 0, disabling the 
+        cache.
+        
+        corpus_path (optional): The path prefix of a WordCorpus built for this
+        voice with build_word_corpus, see attach_corpus.  Defaults to None.
+        
+        phrase_cache_dir (optional): A directory for a PhraseCache of whole
+        rendered phrases on disk.  Defaults to None, disabling the cache.
+        
+        phrase_cache_bytes (optional): The size cap of the phrase cache in 
+        bytes, defaults to 256 MB.
+        
+        cmu_dict (optional): An already loaded dictionary to use instead of 
+        dict_file_path.  Defaults to None, using the shared_cmu_dict for 
+        dict_file_path.
+        
+        compile_dict (optional): If True, compile the dictionary index when 
+        it is missing or stale so that worker processes can share it, see 
+        shared_cmu_dict.  Defaults to False.
+        
+        pipeline (optional): The PreprocessPipeline applied to the samples as
+        they are loaded.  Defaults to None, using load_samples' defaults.
+        
+        target_fs (optional): The sample frequency in Hz to generate audio at,
+        defaults to 44100 Hz.  Every sample is resampled to this rate once as
+        it is loaded, whatever rate it was recorded at.  Lower rates such as
+        8000 or 16000 Hz reduce memory, bandwidth and rendering work.
+        
+        plan_cache_bytes (optional): The memory budget in bytes for caching
+        compiled render plans of phrases, see compile_plan.  Defaults to 1 MB.
+        0 disables the cache.
+        
+        metrics (optional): The SynthesisMetrics to record into, which may be
+        shared by several voices.  Defaults to None, creating a new one.
+        
+        ngram_cache_bytes (optional): The memory budget in bytes for 
+        pre-joining the clips of the most frequent phone bigrams and trigrams 
+        in the dictionary, see NgramClipCache.  Defaults to 0, disabling the
+        cache.  Building it analyses the whole dictionary when the voice is 
+        loaded.
+        
+    Attributes:
+        word_cache: The WordAudioCache of rendered words, or None if caching
+        is disabled.  It is cleared whenever sounds or allo_map is replaced.
+        
+        corpus: The attached WordCorpus of pre-rendered words, or None.  It is
+        detached whenever sounds or allo_map is replaced.
+        
+        phrase_cache: The PhraseCache of rendered phrases, or None if caching
+        is disabled.
+        
+        plan_cache: A WordAudioCache of compiled render plans keyed by the 
+        normalized phrase, or None if caching is disabled.  It is cleared 
+        whenever sounds or allo_map is replaced.
+        
+        config: The arguments this Speakophone was constructed with, used to
+        load the same voice in worker processes.  reload_samples and 
+        reload_allophone_map keep it up to date, but assigning sounds, 
+        cmu_dict or allo_map directly cannot be described by it, so process 
+        pools refuse to run batches after that.
+        
+        fs: The sample frequency in Hz of the generated audio.
+        
+        metrics: The SynthesisMetrics of stage timings and counters for this
+        voice.
+        
+        ngram_cache: The NgramClipCache of pre-joined phone runs, or None if
+        it is disabled.  It is rebuilt whenever sounds, allo_map or cmu_dict
+        is replaced.
+    """
+    
+    def __init__(self, sample_dir, dict_file_path, allo_map_file_path, 
+                 workers=1, pool="process", word_cache_bytes=0, corpus_path=None,
+                 phrase_cache_dir=None, phrase_cache_bytes=256 * 1024 * 1024,
+                 cmu_dict=None, compile_dict=False, pipeline=None, target_fs=DEFAULT_FS,
+                 plan_cache_bytes=1024 * 1024, metrics=None, ngram_cache_bytes=0):
+        self.config = {"sample_dir": sample_dir, "dict_file_path": dict_file_path,
+                       "allo_map_file_path": allo_map_file_path, 
+                       "word_cache_bytes": word_cache_bytes, "corpus_path": corpus_path,
+                       "phrase_cache_dir": phrase_cache_dir, 
+                       "phrase_cache_bytes": phrase_cache_bytes,
+                       "compile_dict": compile_dict, "pipeline": pipeline,
+                       "target_fs": target_fs, "plan_cache_bytes": plan_cache_bytes,
+                       "ngram_cache_bytes": ngram_cache_bytes}
+        self.word_cache = WordAudioCache(word_cache_bytes) if word_cache_bytes > 0 else None
+        self.plan_cache = WordAudioCache(plan_cache_bytes) if plan_cache_bytes > 0 else None
+        self.metrics = metrics if metrics is not None else SynthesisMetrics()
+        self.ngram_cache_bytes = ngram_cache_bytes
+        self.ngram_cache = None
+        self._render_buffer = None
+        self.corpus = None
+        self._fingerprint = None
+        self._phone_table = None
+        self._resolve_lock = threading.Lock()
+        self._replaced = set()
+        if pipeline is None:
+            pipeline = PreprocessPipeline(target_fs=target_fs)
+        elif pipeline.target_fs is None:
+            pipeline = copy.copy(pipeline)
+            pipeline.target_fs = target_fs
+        self.fs = pipeline.target_fs
+        self.phrase_cache = None
+        if phrase_cache_dir is not None:
+            self.phrase_cache = PhraseCache(phrase_cache_dir, phrase_cache_bytes, fs=self.fs)
+        self.workers = workers
+        self.pool = pool
+        self.pipeline = pipeline
+        self.sounds = load_sample_bank(sample_dir, self.fs, pipeline, workers, pool)
+        if cmu_dict is None:
+            cmu_dict = shared_cmu_dict(dict_file_path, compile_index=compile_dict)
+        self.cmu_dict = cmu_dict
+        self.allo_map = load_allophone_map(allo_map_file_path)
+        self._replaced.clear()
+        self.interword_pad = np.zeros(round(4000 * self.fs / DEFAULT_FS)).astype("int16")
+        self._stream = None
+        self._speech_queue = None
+        if corpus_path is not None:
+            self.attach_corpus(corpus_path)
+        if ngram_cache_bytes > 0:
+            self._resolve_phone_table()
+        
+        
+    @property
+    def sounds(self):
+        """
+        The SampleBank of loaded allophone samples keyed by sample name.  A 
+        dict of samples assigned to it is packed into a new SampleBank.
+        """
+        return self._sounds
+    
+    
+    @sounds.setter
+    def sounds(self, sounds):
+        if not isinstance(sounds, SampleBank):
+            sounds = SampleBank.pack(sounds, self.fs)
+        self._sounds = sounds
+        self._replaced.add("sounds")
+        self._voice_changed()
+            
+            
+    @property
+    def cmu_dict(self):
+        """
+        The CMU Sphinx Dictionary mapping words to their phones.
+        """
+        return self._cmu_dict
+    
+    
+    @cmu_dict.setter
+    def cmu_dict(self, cmu_dict):
+        self._cmu_dict = cmu_dict
+        self._replaced.add("cmu_dict")
+        self._voice_changed()
+        
+        
+    @property
+    def allo_map(self):
+        """
+        The dict mapping dictionary phones to sample names.
+        """
+        return self._allo_map
+    
+    
+    @allo_map.setter
+    def allo_map(self, allo_map):
+        self._allo_map = allo_map
+        self._replaced.add("allo_map")
+        self._voice_changed()
+            
+            
+    def _voice_changed(self):
+        """
+        Discards everything rendered with the previous samples, mapping or
+        dictionary.  Cached phrases are keyed by the voice, so they need no 
+        clearing.
+        """
+        self._fingerprint = None
+        self._phone_table = None
+        self._render_buffer = None
+        self.ngram_cache = None
+        if self.word_cache is not None:
+            self.word_cache.clear()
+        if self.plan_cache is not None:
+            self.plan_cache.clear()
+        if self.corpus is not None:
+            logger.info("Detaching word corpus for the previous voice")
+            self.corpus = None
+            
+            
+    def sample_digests(self):
+        """
+        Gets a digest of the audio of each loaded sample.
+        
+        Returns:
+            A dict of hex digests keyed by sample name.
+        """
+        return {name: hashlib.sha1(np.ascontiguousarray(audio).tobytes()).hexdigest() 
+                for name, audio in self.sounds.items()}
+    
+    
+    def voice_fingerprint(self):
+        """
+        Gets a fingerprint identifying this voice: the loaded samples together
+        with the mapping of dictionary phones to them and the dictionary's 
+        pronunciations.  Anything rendered with one voice can be reused by 
+        another with the same fingerprint.
+        
+        Returns:
+            The fingerprint as a hex string.
+        """
+        if self._fingerprint is not None:
+            return self._fingerprint
+        h = hashlib.sha1()
+        for name, digest in sorted(self.sample_digests().items()):
+            h.update("{0}={1};".format(name, digest).encode("utf-8"))
+        for phone, name in sorted(self.allo_map.items()):
+            h.update("{0}>{1};".format(phone, name).encode("utf-8"))
+        h.update("dict={0};".format(cmu_dict_digest(self.cmu_dict)).encode("utf-8"))
+        self._fingerprint = h.hexdigest()
+        return self._fingerprint
+    
+    
+    def phrase_key(self, phrase):
+        """
+        Gets the PhraseCache key for a phrase spoken in this voice, which 
+        covers the normalized words, the voice_fingerprint and the length of
+        the interword padding.
+        
+        Args:
+            phrase (str): The phrase to get the key for.
+            
+        Returns:
+            The key as a hex string.
+        """
+        fingerprint = "{0}:{1}".format(self.voice_fingerprint(), len(self.interword_pad))
+        return PhraseCache.key(self.phrase_words(phrase), fingerprint)
+    
+    
+    def attach_corpus(self, corpus_path):
+        """
+        Attaches a WordCorpus of pre-rendered words, which will then be used
+        for any word it contains instead of assembling the word's phones.  The
+        corpus is only attached if it was built for this voice.
+        
+        Args:
+            corpus_path: The path prefix of the corpus, see corpus_paths.
+            
+        Returns:
+            True if the corpus was attached, False if it is for another voice.
+        """
+        corpus = WordCorpus(corpus_path)
+        if corpus.fingerprint != self.voice_fingerprint():
+            logger.warning("Word corpus %s was built for a different voice, not using it", corpus_path)
+            return False
+        self.corpus = corpus
+        logger.info("Using word corpus %s with %d words", corpus_path, len(corpus))
+        return True
+    
+    
+    def reload_samples(self, sample_dir):
+        """
+        Replaces the loaded allophone samples with those in sample_dir.  Any 
+        cached word audio is discarded.
+        
+        Args:
+            sample_dir: The directory of allophone ".wav" samples, or a sample
+            bank file.
+        """
+        self.sounds = load_sample_bank(sample_dir, self.fs, self.pipeline, self.workers, self.pool)
+        self.config["sample_dir"] = sample_dir
+        self._replaced.discard("sounds")
+        
+        
+    def reload_allophone_map(self, allo_map_file_path):
+        """
+        Replaces the mapping of dictionary phones to sample names.  Any cached
+        word audio is discarded.
+        
+        Args:
+            allo_map_file_path: The path to the mapping file to load.
+        """
+        self.allo_map = load_allophone_map(allo_map_file_path)
+        self.config["allo_map_file_path"] = allo_map_file_path
+        self._replaced.discard("allo_map")
+
+
+    def write_sounds_test(self):
+        """
+        A utility method to write out all of the loaded sounds for examination.
+        These will be written with the suffix "_TESTOUT.wav"
+        """
+        if sd is not None:
+            logger.info("Sound devices:\n%s", sd.query_devices())
+        logger.info("%d sounds found", len(self.sounds))
+        
+        #Test writing
+        for sk, sv in self.sounds.items():
+            n = sk + "_TESTOUT.wav"
+            wv.write(n, self.fs, sv)
+        
+        
+    def generate_audio(self, phrase):
+        """
+        Generates C64 phone -based audio from the phrase provided, provided 
+        that the requisite words and their phe mappings appear in the loaded 
+        dictionary.  The prase will be stripped to contain only letters,
+        spaces, and apostrophes.  Words will be split based on whitespace.
+        If the phrase cache is enabled, phrases already in it are read back
+        from disk and newly rendered phrases are added to it.
+        
+        Args:
+            phrase (str): The phrase which should be "spoken" in the 
+            generated audio.
+            
+        Raises:
+            ValueError if a word from the provided phrase cannot be found in
+            the reference dictionary.
+            
+        Returns:
+            final_audio: The resultant audio generated to say the phrase as a
+            NumPy array of samples.
+        """
+        self.metrics.count("phrases")
+        if self.phrase_cache is not None:
+            key = self.phrase_key(phrase)
+            final_audio = self.phrase_cache.get(key)
+            if final_audio is not None:
+                self.metrics.count("phrase_cache_hits")
+                logger.debug("Phrase cache hit, audio length: %d", len(final_audio))
+                return final_audio
+            self.metrics.count("phrase_cache_misses")
+        
+        final_audio = self.render_phrase(phrase)
+        logger.debug("Total audio length: %d", len(final_audio))
+        
+        if self.phrase_cache is not None:
+            self.phrase_cache.put(key, final_audio)
+        return final_audio
+    
+    
+    def render_phrase(self, phrase, out=None):
+        """
+        Renders the audio for a phrase with a single allocation.  The samples
+        for every word are looked up first so that the total length is known,
+        then each clip is copied straight into place in the output.
+        
+        Args:
+            phrase (str): The phrase which should be "spoken" in the 
+            generated audio.
+            
+            out (optional): A reusable "int16" NumPy array to render into.  It
+            must be at least as long as the rendered phrase.  Defaults to None,
+            allocating a new array of exactly the right size.
+            
+        Raises:
+            ValueError if a word from the provided phrase cannot be found in
+            the reference dictionary, or if out is too short for the phrase.
+            
+        Returns:
+            The rendered audio.  When out is provided this is a view of its 
+            first samples.
+        """
+        if self.corpus is None and self.word_cache is None:
+            with self.metrics.time("lookup"):
+                plan = self.compile_plan(phrase)
+            with self.metrics.time("gather"):
+                return execute_render_plan(self.render_buffer, plan, out)
+        
+        clips = list()
+        with self.metrics.time("lookup"):
+            for w in self.phrase_words(phrase):
+                clips.extend(self.word_clips(w))
+                clips.append(self.interword_pad)
+        
+        with self.metrics.time("concatenation"):
+            return join_clips(clips, out)
+    
+    
+    def render_phrases(self, phrases):
+        """
+        Renders many phrases at once by compiling each into a render plan and
+        executing them all into a single allocation.
+        
+        Args:
+            phrases: A list of the phrases to render.
+            
+        Raises:
+            ValueError if a word from one of the phrases cannot be found in 
+            the reference dictionary.
+            
+        Returns:
+            A list of the rendered audio for each phrase, in order, as views of
+            one shared array.
+        """
+        if self.corpus is not None or self.word_cache is not None:
+            return [self.render_phrase(p) for p in phrases]
+        with self.metrics.time("lookup"):
+            plans = [self.compile_plan(p) for p in phrases]
+        with self.metrics.time("gather"):
+            return execute_render_plans(self.render_buffer, plans)
+    
+    
+    @property
+    def render_buffer(self):
+        """
+        The buffer that render plans index into: the sample bank's buffer, 
+        or when the n-gram cache holds any runs, a tuple of the sample bank's
+        buffer and the n-gram cache's buffer of pre-joined clips.  The bank 
+        is never copied, so a mapped bank stays shared between processes.
+        """
+        if self._render_buffer is None:
+            self._resolve_phone_table()
+        return self._render_buffer
+    
+    
+    def compile_plan(self, phrase):
+        """
+        Compiles a phrase into a render plan: the (offset, length) into 
+        render_buffer of every phone (or cached run of phones) of every word
+        in order, with an offset of -1 for each interword pad of silence.  
+        When the n-gram cache holds any runs, each row also has a source: 0 
+        for the sample bank and 1 for the n-gram cache.  Executing the plan 
+        with execute_render_plan gives the same audio as render_phrase.  
+        Compiled plans are kept in the plan cache when it is enabled.
+        
+        Args:
+            phrase (str): The phrase which should be "spoken" in the 
+            generated audio.
+            
+        Raises:
+            ValueError if a word from the provided phrase cannot be found in
+            the reference dictionary.
+            
+        Returns:
+            The plan as a read-only (n, 2) or (n, 3) "int64" NumPy array.
+        """
+        words = self.phrase_words(phrase)
+        key = "{0}:{1}".format(len(self.interword_pad), " ".join(words))
+        if self.plan_cache is not None:
+            plan = self.plan_cache.get(key)
+            if plan is not None:
+                self.metrics.count("plan_cache_hits")
+                self.metrics.count("words", len(words))
+                self.metrics.count("phones", len(plan) - len(words))
+                return plan
+            self.metrics.count("plan_cache_misses")
+        
+        if self._phone_table is None:
+            self._resolve_phone_table()
+        pad = np.zeros((1, self._sample_plan.shape[1]), dtype="int64")
+        pad[0, :2] = (-1, len(self.interword_pad))
+        parts = list()
+        for w in words:
+            logger.debug("Saying: %s", w)
+            parts.append(self._sample_plan[self._word_pieces(w)])
+            parts.append(pad)
+        plan = np.concatenate(parts) if len(parts) > 0 else np.zeros((0, pad.shape[1]), dtype="int64")
+        self.metrics.count("words", len(words))
+        self.metrics.count("phones", len(plan) - len(words))
+        
+        if self.plan_cache is not None:
+            self.plan_cache.put(key, plan)
+        else:
+            plan.setflags(write=False)
+        return plan
+    
+    
+    def _word_sample_indexes(self, word):
+        """
+        Looks up the indexes into the list of samples of each phone of a word.
+        
+        Raises:
+            ValueError if the word cannot be found in the reference dictionary
+            or one of its phones has no mapped sample.
+        """
+        try:
+            if isinstance(self.cmu_dict, CompiledCMUDict):
+                sample_indexes = self._phone_table[self.cmu_dict.phone_ids(word)]
+            else:
+                sample_indexes = np.array([self._sample_index.get(self.allo_map.get(phone), -1) 
+                                           for phone in self.cmu_dict[word].split(" ")], dtype="int32")
+        except KeyError:
+            raise self._unknown_word(word)
+        if len(sample_indexes) == 0 or (sample_indexes < 0).any():
+            raise self._unknown_word(word)
+        return sample_indexes
+    
+    
+    def _word_pieces(self, word):
+        """
+        Looks up the pieces to gather for a word: the indexes into the list 
+        of samples of each phone, with runs found in the n-gram cache 
+        replaced by the index of their pre-joined clip.
+        
+        Raises:
+            ValueError if the word cannot be found in the reference dictionary
+            or one of its phones has no mapped sample.
+        """
+        sample_indexes = self._word_sample_indexes(word)
+        if self.ngram_cache is None:
+            return sample_indexes
+        pieces = self.ngram_cache.cover(sample_indexes, self._run_index)
+        hits = sum(1 for i in pieces if i >= self._first_run_index)
+        self.metrics.count("ngram_cache_hits", hits)
+        self.metrics.count("ngram_cache_misses", len(pieces) - hits)
+        return pieces
+    
+    
+    def _dictionary_samples(self, table):
+        """
+        Looks up the sample indexes of every word in the dictionary whose 
+        phones all have a mapped sample, for frequent_sample_ngrams, with the
+        table from phone IDs to sample indexes being resolved.
+        
+        Returns:
+            A tuple of the sample indexes of every phone of those words, one 
+            word after another, and the start of each word in them with the
+            end of the last word appended.
+        """
+        if isinstance(self.cmu_dict, CompiledCMUDict):
+            phone_ids, offsets = self.cmu_dict.pronunciations()
+            sequence = table[phone_ids]
+            offsets = offsets.astype("int64")
+            word_of = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            unmapped = np.bincount(word_of, weights=sequence < 0, minlength=len(offsets) - 1)
+            keep = np.repeat(unmapped == 0, np.diff(offsets))
+            lengths = np.diff(offsets)[unmapped == 0]
+            return sequence[keep], np.concatenate(([0], np.cumsum(lengths)))
+        
+        sequence = list()
+        offsets = [0]
+        for phones in self.cmu_dict.values():
+            indexes = [self._sample_index.get(self.allo_map.get(phone), -1) for phone in phones.split(" ")]
+            if len(indexes) > 0 and min(indexes) >= 0:
+                sequence.extend(indexes)
+                offsets.append(len(sequence))
+        return np.array(sequence, dtype="int32"), np.array(offsets, dtype="int64")
+    
+    
+    def _unknown_word(self, word):
+        """
+        Counts an unknown word and makes the ValueError to raise for it.
+        """
+        self.metrics.count("unknown_words")
+        return ValueError("The word \"{0}\" is not in the dictionary".format(word))
+    
+    
+    def phrase_words(self, phrase):
+        """
+        Normalizes a phrase into the list of dictionary words to be spoken.
+        The phrase is upper-cased and stripped to contain only letters, 
+        spaces, and apostrophes, then split on whitespace.
+        
+        Args:
+            phrase (str): The phrase to normalize.
+            
+        Returns:
+            A list of the words (all caps) in the phrase.
+        """
+        phrase = phrase.strip().upper()
+        phrase = re.sub('[^A-Z \']+', '', phrase)
+        return phrase.split()
+    
+    
+    def word_clips(self, word):
         """
-        A utility method to write out all of the loaded sounds for examination.
-        These will be written with the suffix "_TESTOUT.wav"
+        Looks up the samples that make up a single word, in order.  Words in
+        the attached corpus are served from it as a single clip.  Otherwise, 
+        when the word cache is enabled the word is rendered into a single 
+        clip, which is cached for later lookups.
+        
+        Args:
+            word (str): The word (all caps) to look up.
+            
+        Raises:
+            ValueError if the word cannot be found in the reference dictionary
+            or one of its phones has no mapped sample.
+            
+        Returns:
+            clips: A list of the NumPy arrays of samples for each phone, or a
+            list holding the single rendered clip for the word if it comes 
+            from the corpus or word cache.
         """
-        devices = sd.query_devices()
-        print(devices)    
-        print()
-        print(str(len(self.sounds)) + " sounds found")
+        self.metrics.count("words")
+        if self.corpus is not None:
+            audio = self.corpus.get(word)
+            if audio is not None:
+                self.metrics.count("corpus_hits")
+                return [audio]
         
-        #Test writing
-        for sk, sv in self.sounds.items():
-            n = sk + "_TESTOUT.wav"
-            wv.write(n, 44100, sv)
+        if self.word_cache is None:
+            return self._lookup_word_clips(word)
         
+        audio = self.word_cache.get(word)
+        if audio is None:
+            self.metrics.count("word_cache_misses")
+            audio = join_clips(self._lookup_word_clips(word))
+            self.word_cache.put(word, audio)
+        else:
+            self.metrics.count("word_cache_hits")
+        return [audio]
+    
+    
+    def _resolve_phone_table(self):
+        """
+        Resolves the allophone map once into a table from the dictionary's 
+        phone IDs to indexes into a list of the samples, so that each phone
+        of a word is found with a single array index.  Phones with no mapped
+        sample are given an index of -1.  Also tabulates the (offset, length)
+        of each sample in the sample bank for compiling render plans.
         
-    def generate_audio(self, phrase):
+        Threads may render with this voice at the same time, so the table is
+        resolved by one thread at a time and published last, once everything
+        it depends on is in place.
         """
-        Generates C64 phone -based audio from the phrase provided, provided 
-        that the requisite words and their phe mappings appear in the loaded 
-        dictionary.  The prase will be stripped to contain only letters,
-        spaces, and apostrophes.  Words will be split based on whitespace.
+        with self._resolve_lock:
+            if self._phone_table is not None:
+                return
+            names = list(self.sounds)
+            sample_index = {name: i for i, name in enumerate(names)}
+            table = np.full(len(getattr(self.cmu_dict, "phone_names", ())), -1, dtype="int32")
+            for phone_id, phone in enumerate(getattr(self.cmu_dict, "phone_names", ())):
+                table[phone_id] = sample_index.get(self.allo_map.get(phone), -1)
+            
+            self._sample_names = names
+            self._sample_index = sample_index
+            self._sample_list = [self.sounds[name] for name in names]
+            self._sample_plan = np.array([self.sounds.table[name] for name in names], 
+                                         dtype="int64").reshape(-1, 2)
+            self._render_buffer = self.sounds.buffer
+            if self.ngram_cache_bytes > 0:
+                self._build_ngram_cache(table)
+            self._phone_table = table
+            
+            
+    def _build_ngram_cache(self, table):
+        """
+        Builds the n-gram cache of pre-joined clips of the dictionary's most
+        frequent runs of phones, and appends the clips to the samples that 
+        render plans and word_clips draw from.  The runs chosen are recorded
+        next to the dictionary (see ngram_cache_path) under the 
+        voice_fingerprint and budget, so the dictionary is only analysed the
+        first time, not by every voice or worker process loading it.
+        """
+        start = time.perf_counter()
+        runs_file = ngram_cache_path(self.config["dict_file_path"])
+        key = "{0}:{1}".format(self.voice_fingerprint(), self.ngram_cache_bytes)
+        entry = _read_ngram_runs(runs_file, key)
+        if entry is not None and all(name in self._sample_index for run in entry["runs"] for name in run):
+            ranked = [(tuple(self._sample_index[name] for name in run), 0) for run in entry["runs"]]
+            cache = NgramClipCache(ranked, self._sample_list, self.ngram_cache_bytes)
+            cache.coverage = entry["coverage"]
+        else:
+            sequence, offsets = self._dictionary_samples(table)
+            cache = NgramClipCache(frequent_sample_ngrams(sequence, offsets), 
+                                   self._sample_list, self.ngram_cache_bytes)
+            cache.measure_coverage(sequence, offsets)
+            names = [[self._sample_names[i] for i in run] for run in cache.runs]
+            _write_ngram_runs(runs_file, key, {"runs": names, "coverage": cache.coverage})
+        
+        self._first_run_index = len(self._sample_list)
+        self._run_index = dict()
+        runs = list()
+        for i, (run, (offset, length)) in enumerate(cache.runs.items()):
+            self._run_index[run] = self._first_run_index + i
+            self._sample_names.append("+".join(self._sample_names[j] for j in run))
+            self._sample_list.append(cache.buffer[offset:offset + length])
+            runs.append((offset, length, 1))
+        if len(runs) > 0:
+            samples = np.column_stack((self._sample_plan, np.zeros(len(self._sample_plan), dtype="int64")))
+            self._sample_plan = np.concatenate((samples, np.array(runs, dtype="int64")))
+            self._render_buffer = (self.sounds.buffer, cache.buffer)
+        self.ngram_cache = cache
+        logger.info("Cached %d phone runs in %d bytes, saving %.1f%% of pieces across the dictionary, in %.2f s",
+                    len(cache), cache.nbytes, cache.coverage * 100, time.perf_counter() - start)
+    
+    
+    def _lookup_word_clips(self, word):
+        logger.debug("Saying: %s", word)
+        if self._phone_table is None:
+            self._resolve_phone_table()
+        sample_indexes = self._word_pieces(word)
+        clips = [self._sample_list[i] for i in sample_indexes]
+        self.metrics.count("phones", len(clips))
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("MapPhones: %s", " ".join(self._sample_names[i] for i in sample_indexes))
+            logger.debug("Word audio length: %d", len(clips[-1]))
+        return clips
+    
+    
+    def generate_audio_chunks(self, phrase, per_phone=False):
+        """
+        Generates the same audio as generate_audio, but as a generator which
+        yields it a piece at a time while the rest of the phrase is still to
+        be assembled.  Each word is only looked up when the previous chunk 
+        has been consumed.
         
         Args:
             phrase (str): The phrase which should be "spoken" in the 
             generated audio.
             
+            per_phone (optional): If True, yield each phone's samples and the
+            interword pad separately, otherwise (the default) yield one chunk
+            per word including its trailing interword pad.
+            
         Raises:
             ValueError if a word from the provided phrase cannot be found in
-            the reference dictionary.
+            the reference dictionary.  Chunks for the preceding words will 
+            already have been yielded.
             
-        Returns:
-            final_audio: The resultant audio generated to say the phrase as a
-            NumPy array of samples.
+        Yields:
+            NumPy arrays of samples, which joined together form the phrase.
         """
-        phrase = phrase.strip().upper()
-        phrase = re.sub('[^A-Z \']+', '', phrase)
-        words = phrase.split()
-        clips = list()
-
-        for w in words:
-            print("Saying: {0}".format(w))
-            try:
-                for phone in self.cmu_dict[w].split(" "):
-                    print("DictPhone: {0}\tMapPhone: {1}".format(phone, str(self.allo_map[phone])))
-                    s = self.sounds[self.allo_map[phone]]
-                    clips.append(s)
-            except KeyError:
-                raise ValueError("The word \"{0}\" is not in the dictionary".format(w))
-            print("Word audio length: {}".format(len(s)))
-            clips.append(self.interword_pad)
-
-        #Combine audio from words/sounds together
-        final_audio = np.hstack(clips)
-        print("Total audio length: {}".format(len(final_audio)))
-        return final_audio
+        for w in self.phrase_words(phrase):
+            clips = self.word_clips(w)
+            if per_phone:
+                for clip in clips:
+                    yield clip
+                yield self.interword_pad
+            else:
+                clips.append(self.interword_pad)
+                yield join_clips(clips)
     
     
-    def output_audio(self, audio, output_file=None, fs=44100):
+    def output_audio(self, audio, output_file=None, fs=None):
         """
         Takes the provided audio and outputs it either to a sound device or 
-        (if provided) a file.  Auio is written at Fs of 44.1 kHz unless 
-        otherwise provided.
+        (if provided) a file.  Audio is written or played at this 
+        Speakophone's sample frequency unless otherwise provided.
         
         Args:
             audio: An array of samples for the audio to be output.
@@ -270,15 +3658,370 @@ class Speakophone:
             output_file (optional): The file to output the audio to, defaults
             to None and plays to a sound device instead.
             
-            fs (optional): The sample frequency (in Hz) to write to an output 
-            file, defaults to 44100 Hz.
+            fs (optional): The sample frequency (in Hz) of the audio, defaults
+            to the fs of this Speakophone.
         """
-        if output_file is not None:
-            wv.write(output_file, 44100, audio)
-        else:
-            sd.play(audio)
+        if fs is None:
+            fs = self.fs
+        with self.metrics.time("output"):
+            if output_file is not None:
+                wv.write(output_file, fs, audio)
+            else:
+                _sound_device().play(audio, fs)
 
 
+    def stream_audio(self, chunks, output, raw=False):
+        """
+        Writes audio to a file, pipe or socket a chunk at a time, as a ".wav"
+        stream or raw PCM.  Only one chunk needs to be held in memory at a 
+        time.  See AudioStreamWriter.
+        
+        Args:
+            chunks: An iterable of NumPy arrays of samples, such as the 
+            generator from generate_audio_chunks.
+            
+            output: A path or binary file-like object to write to.
+            
+            raw (optional): If True, write raw PCM with no ".wav" header.  
+            Defaults to False.
+            
+        Returns:
+            The number of samples written.
+        """
+        with AudioStreamWriter(output, fs=self.fs, raw=raw) as writer:
+            for chunk in chunks:
+                with self.metrics.time("output"):
+                    writer.write_chunks((chunk,))
+        return writer.frames
+    
+    
+    def stream_phrase(self, phrase, output, raw=False):
+        """
+        Convenience method to stream a phrase to a file, pipe or socket as 
+        it is generated.  Combines generate_audio_chunks and stream_audio from
+        this class.
+        
+        Args:
+            phrase (str): The phrase which should be "spoken" in the 
+            generated audio.
+            
+            output: A path or binary file-like object to write to.
+            
+            raw (optional): If True, write raw PCM with no ".wav" header.  
+            Defaults to False.
+            
+        Raises:
+            ValueError if a word from the provided phrase cannot be found in
+            the reference dictionary.  The words before it will already have 
+            been written.
+            
+        Returns:
+            The number of samples written.
+        """
+        return self.stream_audio(self.generate_audio_chunks(phrase), output, raw=raw)
+    
+    
+    def write_phrase(self, phrase, output_file):
+        """
+        Writes the audio for a phrase to a ".wav" file.  If the phrase is in 
+        the phrase cache its file is copied directly, with no synthesis or 
+        encoding.
+        
+        Args:
+            phrase (str): The phrase which should be "spoken" in the 
+            generated audio.
+            
+            output_file: The file to write the audio to.
+            
+        Raises:
+            ValueError if a word from the provided phrase cannot be found in
+            the reference dictionary.
+        """
+        if self.phrase_cache is not None and self.phrase_cache.copy_to(self.phrase_key(phrase), output_file):
+            logger.debug("Copied cached phrase to %s", output_file)
+            return
+        self.output_audio(self.generate_audio(phrase), output_file=output_file)
+        
+        
+    def _map_batch(self, func, jobs, workers, pool, max_chunksize=None):
+        """
+        Runs batch jobs either on this Speakophone, serially or in a pool of 
+        threads, or across a pool of worker processes which each load this 
+        voice once.  func is called with the Speakophone followed by the 
+        arguments of a job.
+        """
+        return list(self._imap_batch(func, jobs, workers, pool, max_chunksize))
+    
+    
+    def _imap_batch(self, func, jobs, workers, pool, max_chunksize=None):
+        """
+        The same as _map_batch, but yields the results in order as they are 
+        ready, see imap_in_pool.
+        
+        Raises:
+            ValueError if a process pool is asked for after sounds, cmu_dict 
+            or allo_map were assigned directly, as the workers could not load
+            the same voice from config.
+        """
+        if workers == 1 or len(jobs) <= 1 or pool == "thread":
+            #Threads share this voice, so nothing needs loading or swapping in
+            yield from imap_in_pool(func, [(self,) + tuple(job) for job in jobs], workers, pool)
+            return
+        
+        if self._replaced:
+            raise ValueError("Worker processes cannot load this voice after assigning {0} directly; "
+                             "use pool=\"thread\" or a reload method".format(", ".join(sorted(self._replaced))))
+        
+        chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4))
+        if max_chunksize is not None:
+            chunksize = min(chunksize, max_chunksize)
+        yield from imap_in_pool(_in_batch_worker, [(func,) + tuple(job) for job in jobs], workers, 
+                                pool, initializer=_init_batch_worker, initargs=(self.config,), 
+                                chunksize=chunksize)
+        
+        
+    def render_document_chunk(self, text, offset=0):
+        """
+        Renders a chunk of a document, such as a sentence from 
+        split_document, skipping any word which cannot be spoken rather than
+        failing the whole chunk.  Unlike generate_audio, the text is split 
+        into words on any whitespace, line breaks included.
+        
+        Args:
+            text (str): The text to render.
+            
+            offset (optional): The position of the text in the document, 
+            added to the positions of unknown words.  Defaults to 0.
+            
+        Returns:
+            A tuple of the rendered audio and a list of the (position, word)
+            of each word which was skipped, where position is the index of 
+            the word's first character in the document.
+        """
+        if self._phone_table is None:
+            self._resolve_phone_table()
+        known = list()
+        unknown = list()
+        for token in re.finditer(r"\S+", text):
+            for w in self.phrase_words(token.group()):
+                try:
+                    self._word_sample_indexes(w)
+                    known.append(w)
+                except ValueError:
+                    unknown.append((offset + token.start(), w))
+        return self.render_phrase(" ".join(known)), unknown
+    
+    
+    def generate_document_chunks(self, text, workers=None, pool="process", max_words=100):
+        """
+        Renders a whole document, split into sentences with split_document 
+        which are rendered in parallel across a pool of workers that each 
+        load this voice once.  The audio of each chunk is yielded in order as
+        soon as it and every chunk before it are ready, so a long document 
+        can be written out while the rest is still being rendered.  Joined 
+        together, the chunks give the same audio as speaking every known word
+        as one phrase.
+        
+        Args:
+            text (str): The document to render.
+            
+            workers (optional): The number of workers, see map_in_pool.  
+            Defaults to None, one per CPU.
+            
+            pool (optional): "process" or "thread", defaults to "process".
+            
+            max_words (optional): The most words in a chunk, see 
+            split_document.  Defaults to 100.
+            
+        Yields:
+            A tuple of each chunk's audio and the (position, word) of each 
+            word skipped in it, as from render_document_chunk.
+        """
+        jobs = [(chunk, offset) for offset, chunk in split_document(text, max_words)]
+        logger.info("Rendering document of %d chunks", len(jobs))
+        #Small chunks of jobs per worker, so the first chunks of audio arrive quickly
+        return self._imap_batch(_batch_document_chunk, jobs, workers, pool, max_chunksize=16)
+    
+    
+    def write_document(self, text, output, workers=None, pool="process", raw=False):
+        """
+        Renders a whole document in parallel with generate_document_chunks,
+        writing each chunk to a ".wav" stream or raw PCM in order as it is 
+        ready, see AudioStreamWriter.  Only the chunks waiting to be written 
+        are held in memory, however long the document.  Words which cannot be
+        spoken are skipped and reported rather than aborting the document.
+        
+        Args:
+            text (str): The document to render.
+            
+            output: A path or binary file-like object to write to.
+            
+            workers (optional): The number of workers, see map_in_pool.  
+            Defaults to None, one per CPU.
+            
+            pool (optional): "process" or "thread", defaults to "process".
+            
+            raw (optional): If True, write raw PCM with no ".wav" header.  
+            Defaults to False.
+            
+        Returns:
+            A list of the (position, word) of each word which was skipped, 
+            in order, where position is the index of the word's first 
+            character in text.
+        """
+        unknown = list()
+        with AudioStreamWriter(output, fs=self.fs, raw=raw) as writer:
+            for audio, skipped in self.generate_document_chunks(text, workers, pool):
+                with self.metrics.time("output"):
+                    writer.write_chunks((audio,))
+                unknown.extend(skipped)
+        return unknown
+    
+    
+    def generate_batch(self, phrases, workers=None, pool="process"):
+        """
+        Generates the audio for many phrases, spread across a pool of workers 
+        which each load this voice once.  A phrase which cannot be spoken 
+        (e.g. because of an unknown word) is reported in the results rather 
+        than aborting the batch.
+        
+        Args:
+            phrases: A list of the phrases to generate.
+            
+            workers (optional): The number of workers, see map_in_pool.  
+            Defaults to None, one per CPU.  With 1 worker the phrases are 
+            generated on this Speakophone.
+            
+            pool (optional): "process" or "thread", defaults to "process".
+            
+        Returns:
+            A list with an (audio, error) tuple for each phrase, in order.  
+            audio is the NumPy array of samples, or None if the phrase failed,
+            in which case error is a message describing why.
+        """
+        return self._map_batch(_batch_generate, [(p,) for p in phrases], workers, pool)
+    
+    
+    def write_batch(self, phrases, output_dir, workers=None, pool="process"):
+        """
+        Writes one ".wav" file per phrase into output_dir, spread across a pool
+        of workers which each load this voice once.  Files are numbered in 
+        the order of the phrases.  A phrase which cannot be spoken is reported
+        in the results rather than aborting the batch.
+        
+        Args:
+            phrases: A list of the phrases to write.
+            
+            output_dir: The directory to write the files to.  It is created if
+            it does not exist.
+            
+            workers (optional): The number of workers, see map_in_pool.  
+            Defaults to None, one per CPU.
+            
+            pool (optional): "process" or "thread", defaults to "process".
+            
+        Returns:
+            A list with an (output_file, error) tuple for each phrase, in 
+            order.  output_file is None if the phrase failed, in which case 
+            error is a message describing why.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        width = len(str(len(phrases)))
+        jobs = list()
+        for i, phrase in enumerate(phrases):
+            name = "_".join(self.phrase_words(phrase))[:40]
+            filename = "{0:0{1}d}_{2}.wav".format(i + 1, width, name)
+            jobs.append((phrase, os.path.join(output_dir, filename)))
+        return self._map_batch(_batch_write, jobs, workers, pool)
+    
+    
+    def play_stream(self, chunks, fs=None):
+        """
+        Plays chunks of audio on a persistent output stream as they are 
+        produced, so playback of the first chunk begins while later chunks 
+        are still being generated.  The stream is opened on first use and
+        kept open between calls; see close_stream.
+        
+        Args:
+            chunks: An iterable of arrays of samples, such as the generator 
+            returned by generate_audio_chunks.
+            
+            fs (optional): The sample frequency (in Hz) to play at, defaults 
+            to the fs of this Speakophone.
+        """
+        if fs is None:
+            fs = self.fs
+        if self._stream is not None and self._stream.samplerate != fs:
+            self.close_stream()
+        if self._stream is None:
+            self._stream = _sound_device().OutputStream(samplerate=fs, channels=1, dtype="int16")
+            self._stream.start()
+        
+        for chunk in chunks:
+            with self.metrics.time("output"):
+                self._stream.write(np.ascontiguousarray(chunk, dtype="int16"))
+            
+            
+    def close_stream(self, cancel=False):
+        """
+        Closes the persistent output stream used by play_stream and the 
+        speech queue used by say_async, if open.
+        
+        Args:
+            cancel (optional): If True, drop any phrases still queued by 
+            say_async, otherwise (the default) wait for them to be spoken.
+        """
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if self._speech_queue is not None:
+            self._speech_queue.close(cancel)
+            self._speech_queue = None
+            
+            
+    @property
+    def speech_queue(self):
+        """
+        The SpeechQueue used by say_async, playing to the sound device.  It
+        is started on first use and closed by close_stream.
+        """
+        if self._speech_queue is None:
+            self._speech_queue = SpeechQueue(self)
+        return self._speech_queue
+    
+    
+    def say_async(self, phrase):
+        """
+        Queues a phrase to be played aloud in the background and returns 
+        straight away.  Phrases are played in order with no gaps, and the 
+        next is synthesized while the current one plays.  Use 
+        speech_queue.flush to wait for them, or speech_queue.cancel to stop.
+        
+        Args:
+            phrase (str): The phrase which should be "spoken" in the 
+            generated audio.
+        """
+        self.speech_queue.say_async(phrase)
+    
+    
+    def say_streaming(self, phrase):
+        """
+        Convenience method to play aloud some phrase with low latency, 
+        starting on the first word while the rest are still being generated.
+        Combines generate_audio_chunks and play_stream from this class.
+        
+        Args:
+            phrase (str): The phrase which should be "spoken" in the 
+            generated audio.
+            
+        Raises:
+            ValueError if a word from the provided phrase cannot be found in
+            the reference dictionary.  The words before it will already have 
+            been played.
+        """
+        self.play_stream(self.generate_audio_chunks(phrase))
+    
+    
     def say(self, phrase):
         """
         Convenience method to generate and play aloud some phrase.
@@ -295,21 +4038,129 @@ class Speakophone:
         self.output_audio(self.generate_audio(phrase))
         
     
-def main():
-    print("Running Speakophone")
-  
-    #di_path = os.path.join(directory, dict_filename)
+def run_batch(app, batch_file, output_dir, workers=None):
+    """
+    Writes one ".wav" file per non-blank line of batch_file, reporting each 
+    phrase which could not be spoken.
+    
+    Args:
+        app: The Speakophone to speak the phrases with.
+        
+        batch_file: The file of phrases, one per line, or "-" for stdin.
+        
+        output_dir: The directory to write the files to.
+        
+        workers (optional): The number of worker processes, defaults to None,
+        one per CPU.
+        
+    Returns:
+        The number of phrases which failed.
+    """
+    if batch_file == "-":
+        phrases = [line.strip() for line in sys.stdin]
+    else:
+        with open(batch_file, "r") as f:
+            phrases = [line.strip() for line in f]
+    phrases = [p for p in phrases if p != ""]
     
-    samp_dir = "../Samples/Keith-AllophonesWords-v2"
-    dict_file = "../Samples/CMU-SphinxDict/cmudict_SPHINX_40.txt"
-    map_file = "../Samples/Keith-AllophonesWords-v2/SphinxPhones_40__Keith_mapping.txt"
+    logger.info("Writing %d phrases to %s", len(phrases), output_dir)
+    results = app.write_batch(phrases, output_dir, workers=workers)
     
-    app = Speakophone(sample_dir=samp_dir,
-                      dict_file_path=dict_file,
-                      allo_map_file_path=map_file)
+    failures = 0
+    for i, (phrase, (output_file, error)) in enumerate(zip(phrases, results)):
+        if error is not None:
+            failures += 1
+            logger.warning("Phrase %d \"%s\" failed: %s", i + 1, phrase, error)
+    logger.info("Wrote %d of %d phrases", len(phrases) - failures, len(phrases))
+    return failures
+
+
+def run_document(app, document_file, output, workers=None):
+    """
+    Renders a whole document into one ".wav" file, in parallel across worker
+    processes, reporting the line and column of each word which could not be
+    spoken.
+    
+    Args:
+        app: The Speakophone to speak the document with.
+        
+        document_file: The document's text file, or "-" for stdin.
+        
+        output: The ".wav" file to write, or a binary file-like object such 
+        as sys.stdout.buffer.
+        
+        workers (optional): The number of worker processes, defaults to None,
+        one per CPU.
+        
+    Returns:
+        The number of words which were skipped.
+    """
+    if document_file == "-":
+        text = sys.stdin.read()
+    else:
+        with open(document_file, "r") as f:
+            text = f.read()
+    
+    start = time.perf_counter()
+    unknown = app.write_document(text, output, workers=workers)
+    for position, word in unknown:
+        line = text.count("\n", 0, position) + 1
+        column = position - text.rfind("\n", 0, position)
+        logger.warning("Skipped \"%s\" at line %d, column %d", word, line, column)
+    logger.info("Spoke the document in %.2f s, skipping %d words", 
+                time.perf_counter() - start, len(unknown))
+    return len(unknown)
+
+
+def run_pipe(app, output, raw=False):
+    """
+    Speaks each non-blank line read from stdin into one continuous ".wav" or 
+    raw PCM stream, writing every word as soon as it is generated.  Phrases 
+    which cannot be spoken are reported and skipped.
+    
+    Args:
+        app: The Speakophone to speak the phrases with.
+        
+        output: The binary file-like object to stream to, e.g. 
+        sys.stdout.buffer.
+        
+        raw (optional): If True, write raw PCM with no ".wav" header.  
+        Defaults to False.
+        
+    Returns:
+        The number of phrases which failed.
+    """
+    failed = 0
+    with AudioStreamWriter(output, fs=app.fs, raw=raw) as writer:
+        for line in sys.stdin:
+            phrase = line.strip()
+            if phrase == "":
+                continue
+            try:
+                writer.write_chunks(app.generate_audio_chunks(phrase))
+            except ValueError as e:
+                failed += 1
+                logger.warning("Skipped \"%s\": %s", phrase, e)
+    return failed
 
+
+def run_repl(app, stream=False):
+    """
+    Speaks phrases typed on stdin until a blank line.  A phrase starting with
+    ">" is written to a ".wav" file named after it instead.  Phrases are 
+    spoken in the background with say_async, so the next can be typed while
+    one is still playing.  A phrase which cannot be spoken is logged and 
+    skipped.
     
+    Args:
+        app: The Speakophone to speak the phrases with.
+        
+        stream (optional): If True, start playing each phrase while the rest
+        of it is still being generated, waiting for it to finish before 
+        reading the next.  Defaults to False.
+    """
     #Read input and speak
+    cancel = False
     try:
         keep_speaking = True
         while keep_speaking:
@@ -322,17 +4173,128 @@ def main():
                 phrase = phrase[1:]
                 write_file = True
             
-            spoken_phrase = app.generate_audio(phrase)
-            
-            if write_file:
-                app.output_audio(spoken_phrase, output_file="{0}.wav".format(phrase))
-            else:
-                app.output_audio(spoken_phrase)
+            #A phrase which cannot be spoken is skipped rather than ending the REPL
+            try:
+                if stream and not write_file:
+                    app.say_streaming(phrase)
+                elif write_file:
+                    app.write_phrase(phrase, output_file="{0}.wav".format(phrase))
+                else:
+                    app.say_async(phrase)
+            except ValueError as e:
+                logger.warning("Skipped \"%s\": %s", phrase, e)
     except KeyboardInterrupt:
         print("Keyboard Interrupt")
+        cancel = True
+    finally:
+        app.close_stream(cancel)
     
     print("Goodbye")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Speak phrases typed on stdin using allophone samples.")
+    parser.add_argument("--samples", default="../Samples/Keith-AllophonesWords-v2",
+                        help="directory of allophone .wav samples, or a sample bank file")
+    parser.add_argument("--save-bank", metavar="FILE",
+                        help="pack the loaded samples into a memory-mappable sample bank FILE and exit")
+    parser.add_argument("--dict", default="../Samples/CMU-SphinxDict/cmudict_SPHINX_40.txt",
+                        help="CMU Sphinx dictionary file")
+    parser.add_argument("--map", default="../Samples/Keith-AllophonesWords-v2/SphinxPhones_40__Keith_mapping.txt",
+                        help="allophone mapping file")
+    parser.add_argument("--rate", type=int, default=DEFAULT_FS,
+                        help="output sample rate in Hz, e.g. 8000 or 16000 (default: 44100)")
+    parser.add_argument("--compile-dict", action="store_true",
+                        help="compile the dictionary to a binary index for fast startup and exit")
+    parser.add_argument("--share-dict", action="store_true",
+                        help="compile the dictionary index if needed so that worker processes share one mapped copy")
+    parser.add_argument("--corpus", metavar="PREFIX",
+                        help="use a pre-rendered word corpus built with --build-corpus")
+    parser.add_argument("--build-corpus", metavar="PREFIX",
+                        help="render every dictionary word into a corpus at PREFIX and exit")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="write one .wav per line of FILE (or - for stdin) to --out-dir and exit")
+    parser.add_argument("--out-dir", default=".",
+                        help="directory for the .wav files written by --batch (default: .)")
+    parser.add_argument("--document", metavar="FILE",
+                        help="speak the whole text FILE (or - for stdin) into --output in parallel and exit")
+    parser.add_argument("--output", default="document.wav",
+                        help=".wav file written by --document, or - for stdout (default: document.wav)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes for --batch, --document and --build-corpus "
+                             "(default: one per CPU)")
+    parser.add_argument("--phrase-cache", metavar="DIR",
+                        help="cache rendered phrases as .wav files in DIR")
+    parser.add_argument("--phrase-cache-mb", type=int, default=256,
+                        help="size cap of the phrase cache in MB (default: 256)")
+    parser.add_argument("--ngram-cache-mb", type=float, default=0,
+                        help="pre-join the most frequent phone bigrams and trigrams in up to this many MB (default: 0, off)")
+    parser.add_argument("--stream", action="store_true",
+                        help="start playing each phrase while the rest of it is still being generated")
+    parser.add_argument("--log-level", default="info",
+                        choices=["debug", "info", "warning", "error"],
+                        help="level of the messages logged to stderr (default: info)")
+    parser.add_argument("--metrics", action="store_true",
+                        help="print the synthesis timings and counters as JSON to stderr on exit")
+    parser.add_argument("--pipe", choices=["wav", "pcm"],
+                        help="stream every line of stdin to stdout as one .wav or raw 16-bit PCM stream and exit")
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)s %(name)s: %(message)s")
+    
+    #Keep stdout for the audio when piping, and send messages to stderr
+    pipe_output = None
+    if args.pipe or (args.document and args.output == "-"):
+        pipe_output = sys.stdout.buffer
+        sys.stdout = sys.stderr
+    
+    print("Running Speakophone")
+  
+    #di_path = os.path.join(directory, dict_filename)
+    
+    samp_dir = args.samples
+    dict_file = args.dict
+    map_file = args.map
+    
+    if args.compile_dict:
+        compile_cmu_dict(dict_file)
+        return
+    
+    app = Speakophone(sample_dir=samp_dir,
+                      dict_file_path=dict_file,
+                      allo_map_file_path=map_file,
+                      corpus_path=args.corpus,
+                      phrase_cache_dir=args.phrase_cache,
+                      phrase_cache_bytes=args.phrase_cache_mb * 1024 * 1024,
+                      compile_dict=args.share_dict,
+                      target_fs=args.rate,
+                      ngram_cache_bytes=int(args.ngram_cache_mb * 1024 * 1024))
+    
+    if args.save_bank:
+        app.sounds.save(args.save_bank)
+        return
+    
+    if args.build_corpus:
+        build_word_corpus(app, args.build_corpus, workers=args.workers)
+        return
+    
+    if args.batch:
+        run_batch(app, args.batch, args.out_dir, args.workers)
+    elif args.document:
+        run_document(app, args.document, pipe_output or args.output, args.workers)
+    elif pipe_output is not None:
+        run_pipe(app, pipe_output, raw=args.pipe == "pcm")
+    else:
+        run_repl(app, args.stream)
     
+    if args.metrics:
+        snapshot = app.metrics.snapshot()
+        if app.ngram_cache is not None:
+            snapshot["ngram_cache"] = app.ngram_cache.stats()
+        print(json.dumps(snapshot, indent=2), file=sys.stderr)
 
 
 
@@ -6,13 +6,18 @@ Created on Wed Nov 20 18:15:34 2019
 """
 
 import json
-from random import randint
-from random import choice
-from Speakophone import Speakophone
+from Speakophone import (Speakophone, PreprocessPipeline, SampleBank, WordAudioCache,
+                         load_wav_files, load_sample_bank, execute_render_plan, map_in_pool, 
+                         DEFAULT_FS)
+import argparse
+import copy
+import logging
 import numpy as np
-import scipy.io.wavfile as wv
 import os
-from pathlib import Path
+import threading
+
+#The categories of phrase clips, in the order they are stitched together
+PHRASE_CATEGORIES = ["intro", "number", "d", "segue", "joining", "outro"]
     
 ones = {
     0: '', 1: 'one', 2: 'two', 3: 'three', 4: 'four', 5: 'five', 6: 'six',
@@ -75,9 +80,9 @@ def _join(*args):
     return ' '.join(filter(bool, args))
     
     
-def roll_dice(num_dice=1, dice_size=6):
+def roll_dice(num_dice=1, dice_size=6, rng=None):
     """
-    Rolls the specified number of n-sided dice.
+    Rolls the specified number of n-sided dice, all in one call to the RNG.
     
     Args:
         num_dice (int): The number of dice to roll, defualts to 1.  If 
@@ -86,15 +91,15 @@ def roll_dice(num_dice=1, dice_size=6):
         dice_size (int): The number of sides on the die being rolled, defaults 
         to 6.  If dice_size is less than 1, the value is clamped to 1.
         
+        rng (optional): The NumPy Generator to roll with, defaults to None 
+        which uses a new unseeded np.random.default_rng().
+        
     Returns:
-        results (list of int): A list containing all of the results.
+        results: A NumPy array of "int64" containing all of the results.
     """
-    
-    results = list()
-    dice_size = max(1, dice_size)
-    for i in range(0,num_dice):
-        results.append(randint(1, dice_size))
-    return results
+    if rng is None:
+        rng = np.random.default_rng()
+    return rng.integers(1, max(1, dice_size), size=max(1, num_dice), endpoint=True)
 
 
 def generate_dice_audio_samples():
@@ -170,14 +175,56 @@ class DiceRoller:
     These will all be read in and randomly selected from to assemble the
     proper audio responses for rolls.
     
+    Instead of a configuration file, a dice voice bundle built with 
+    build_dice_bundle can be given.  This is a single SampleBank file of 
+    every phrase, which is memory-mapped so that startup is one file open 
+    and every roller process opening it shares the same pages.
+    
     Phrases are stitched together as follows:
     
         Intro | num_dice | "Dee" | dice_size | Segue | [Result | "And"] | Outro
         With as many Result/And groups  as num_dice rolled.
     
+    Numbers with no file of their own are said by joining the files for each
+    of their words, e.g. "twenty" and "one" for 21.  If the number of dice 
+    cannot be said that way, generating the response raises a ValueError.
+    
+    All of the phrase files are packed into one SampleBank, and each distinct
+    number rolled is tabulated as (offset, length) segments of it, so a roll
+    of any number of dice is rendered into a single preallocated array.  The
+    prefix of a response (Intro to Segue) only depends on the dice and which
+    intro, "Dee" and segue are chosen, so each prefix is rendered once and 
+    kept in a cache of prefix templates.
+    
+    A DiceRoller may be used from several threads at once.
+    
     
     Args:
-        config_file: The path to the configuration file described above.
+        config_file: The path to the configuration file described above, or 
+        to a dice voice bundle.
+        
+        workers (optional): The number of workers used to load the phrase 
+        files, see Speakophone.map_in_pool.  Defaults to 1, loading serially.
+        
+        pool (optional): "process" or "thread", the kind of pool used to load
+        the phrase files when workers is not 1.  Defaults to "process".
+        
+        pipeline (optional): A Speakophone.PreprocessPipeline to apply to the
+        phrase files as they are loaded.  Defaults to None, using the files 
+        as recorded apart from resampling.  Bundles are saved already 
+        processed, so it does not apply to them.
+        
+        seed (optional): The seed for the roller's np.random.default_rng, so 
+        that rolls and phrase choices can be reproduced.  Defaults to None, 
+        seeding from the OS.
+        
+        prefix_cache_bytes (optional): The memory budget in bytes for the 
+        cache of rendered prefix templates, defaults to 16 MB.  0 disables 
+        the cache.
+        
+        target_fs (optional): The sample frequency in Hz to generate roll 
+        audio at, defaults to 44100 Hz.  Every phrase file is resampled to 
+        this rate once as it is loaded, whatever rate it was recorded at.
         
         
     Attributes:
@@ -198,21 +245,169 @@ class DiceRoller:
 
         outro_phrases: A list of NumPy arrays for the samples of outro-suitable
         wav files
+        
+        fs: The sample frequency in Hz of the generated roll audio.
+        
+        bank: The SampleBank of every phrase, named "category/name" e.g. 
+        "number/six" or "intro/0", with categories from PHRASE_CATEGORIES.
+        
+        rng: The np.random.Generator used for rolls and phrase choices by 
+        generate_roll_audio.
+        
+        prefix_cache: The WordAudioCache of rendered prefix templates, or None
+        if caching is disabled.
     
     """
     
-    def __init__(self, config_file):
+    def __init__(self, config_file, workers=1, pool="process", pipeline=None, target_fs=DEFAULT_FS,
+                 seed=None, prefix_cache_bytes=16 * 1024 * 1024):
+        self.workers = workers
+        self.pool = pool
+        if pipeline is None:
+            pipeline = PreprocessPipeline(threshold=None, cutoff=None, target_fs=target_fs)
+        elif pipeline.target_fs is None:
+            pipeline = copy.copy(pipeline)
+            pipeline.target_fs = target_fs
+        self.pipeline = pipeline
+        self.fs = pipeline.target_fs
+        
+        self._seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self._seed_sequence)
+        self._lock = threading.Lock()
+        self.prefix_cache = WordAudioCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        
+        if SampleBank.is_bank_file(config_file):
+            self.bank = load_sample_bank(config_file, self.fs)
+            self._use_bank()
+            return
+        
         with open(config_file, 'r') as phrase_config_file:
             phrase_config = json.load(phrase_config_file)
         
         sample_dir = phrase_config["sample_directory"]
-        
         self.intro_phrases = self.load_generic_wavs(os.path.join(sample_dir, phrase_config["intro_phrases"]))
         self.number_phrases = self.load_number_wavs(os.path.join(sample_dir, phrase_config["number_phrases"]))
         self.d_phrases = self.load_generic_wavs(os.path.join(sample_dir, phrase_config["d_phrases"]))
         self.segue_phrases = self.load_generic_wavs(os.path.join(sample_dir, phrase_config["segue_phrases"]))
         self.joining_phrases = self.load_generic_wavs(os.path.join(sample_dir, phrase_config["joining_phrases"]))
         self.outro_phrases = self.load_generic_wavs(os.path.join(sample_dir, phrase_config["outro_phrases"]))
+        self._pack_phrases()
+        
+        
+    def _pack_phrases(self):
+        """
+        Packs the loaded phrases into the roller's SampleBank.
+        """
+        sounds = {"number/" + name: clip for name, clip in self.number_phrases.items()}
+        for category, clips in [("intro", self.intro_phrases), ("d", self.d_phrases),
+                                ("segue", self.segue_phrases), ("joining", self.joining_phrases),
+                                ("outro", self.outro_phrases)]:
+            for i, clip in enumerate(clips):
+                sounds["{0}/{1}".format(category, i)] = clip
+        self.bank = SampleBank.pack(sounds, self.fs)
+        self._use_bank()
+        
+        
+    def save_bundle(self, bundle_file):
+        """
+        Saves every phrase of this roller to a single dice voice bundle file,
+        which a DiceRoller can be constructed from directly.
+        
+        Args:
+            bundle_file: The path to write the bundle to.
+        """
+        self.bank.save(bundle_file)
+        
+        
+    def _use_bank(self):
+        """
+        Points the phrase attributes at views into the roller's SampleBank, 
+        and tabulates the (offset, length) segments of each category's 
+        phrases for rendering.
+        """
+        names = {category: list() for category in PHRASE_CATEGORIES}
+        for name in self.bank:
+            category, _, clip_name = name.partition("/")
+            names[category].append(clip_name)
+        
+        clips = {category: [self.bank["{0}/{1}".format(category, n)] for n in category_names]
+                 for category, category_names in names.items()}
+        self.intro_phrases = clips["intro"]
+        self.number_phrases = dict(zip(names["number"], clips["number"]))
+        self.d_phrases = clips["d"]
+        self.segue_phrases = clips["segue"]
+        self.joining_phrases = clips["joining"]
+        self.outro_phrases = clips["outro"]
+        
+        self._rows = {category: np.array([self.bank.table["{0}/{1}".format(category, n)] 
+                                          for n in category_names], dtype="int64").reshape(-1, 2)
+                      for category, category_names in names.items()}
+        
+        
+    def _choose(self, category, rng, count=None):
+        """
+        Randomly chooses the index of one (or count) phrases of a category.
+        """
+        available = len(self._rows[category])
+        if available == 0:
+            raise ValueError("There are no {0} phrases to choose from".format(category))
+        return rng.integers(available, size=count)
+    
+    
+    def _number_segments(self, value):
+        """
+        Gets the segments which say a number, using the file for the whole 
+        number if there is one or else the files for each of its words.
+        
+        Raises:
+            KeyError naming the first word with no file.
+        """
+        text = say_number(value)
+        words = [text] if text in self.number_phrases else text.split(" ")
+        segments = list()
+        for w in words:
+            if w not in self.number_phrases:
+                raise KeyError(w)
+            segments.append(self.bank.table["number/" + w])
+        return np.array(segments, dtype="int64")
+    
+    
+    def _number_table(self, values):
+        """
+        Tabulates the segments which say each of the given numbers, as a 
+        (len(values), width, 2) array in the same order.  Numbers which take
+        fewer than width segments are padded with empty segments.  Only the 
+        numbers actually rolled are tabulated, so the size of the dice does 
+        not matter.
+        
+        Raises:
+            ValueError if there is no file for a word of one of the numbers.
+        """
+        segments = list()
+        for value in values:
+            try:
+                segments.append(self._number_segments(int(value)))
+            except KeyError as e:
+                raise ValueError("Cannot say the result {0}: there is no number phrase for {1}".format(value, e))
+        
+        width = max([len(s) for s in segments] + [0])
+        table = np.tile(np.array([-1, 0], dtype="int64"), (len(segments), width, 1))
+        for i, s in enumerate(segments):
+            table[i, :len(s)] = s
+        return table
+        
+        
+    def _read_wavs(self, directory):
+        """
+        Reads every "*.wav" in the directory, in listing order, using the 
+        roller's configured workers and preprocessing pipeline.
+        
+        Returns:
+            A list of (name, samples) tuples.
+        """
+        paths = [os.path.join(directory, file) for file in os.listdir(directory) 
+                 if file.endswith(".wav")]
+        return load_wav_files(paths, self.pipeline, self.workers, self.pool)
         
         
     def load_generic_wavs(self, directory):
@@ -226,14 +421,7 @@ class DiceRoller:
             samples: A list of NumPy arrays of each file's audio samples.
         """
         
-        samples = list()
-        for file in os.listdir(directory):
-            if file.endswith(".wav"):
-                joined_path = os.path.join(directory, file)
-                fs, wav_array = wv.read(joined_path)
-                print("Loaded {0} with {1} samples at {2}".format(joined_path, len(wav_array), fs))
-                samples.append(wav_array)
-        return samples
+        return [wav_array for _, wav_array in self._read_wavs(directory)]
     
     
     def load_number_wavs(self, directory):
@@ -250,22 +438,15 @@ class DiceRoller:
             with values that are the NumPy array of the audio samples.
         """
         
-        samples = dict()
-        for file in os.listdir(directory):
-            if file.endswith(".wav"):
-                joined_path = os.path.join(directory, file)
-                p = Path(joined_path)
-                number_name = p.resolve().stem.strip()
-                fs, wav_array = wv.read(joined_path)
-                print("Loaded {0} with {1} samples at {2}".format(joined_path, len(wav_array), fs))
-                samples[number_name] = wav_array
-        return samples
+        return dict(self._read_wavs(directory))
     
     
     def generate_roll_audio(self, num_dice=1, dice_size=6):
         """
         Generates stitched-together audio based on the samples read in by the
-        Dice Roller to read out the provided dice roll's results.
+        Dice Roller to read out the provided dice roll's results.  The dice 
+        and the joiners between results are all chosen in bulk, and the 
+        response is written into one array allocated at its final length.
         
         Args:
             num_dice (int): The number of dice to roll, defualts to 1.  Must 
@@ -275,7 +456,9 @@ class DiceRoller:
             defaults to 6.  Must not be less than 1.
             
         Raises:
-            ValueError: if num_dice or dice_size are less than 1.
+            ValueError: if num_dice or dice_size are less than 1, or if there
+            is no number phrase for a word of num_dice, dice_size or one of 
+            the results rolled.
             
         Returns:
             audio: A NumPy array that contains the audio samples of the
@@ -283,34 +466,170 @@ class DiceRoller:
             
         """
         
+        with self._lock:
+            prefix, body = self._compile_roll(num_dice, dice_size, self.rng)
+        return self._render_roll(prefix, body)
+    
+    
+    def generate_rolls(self, rolls, seed=None, workers=1):
+        """
+        Generates the audio for many dice rolls in one pass.  Each roll gets 
+        its own RNG spawned from one np.random.SeedSequence, so the results 
+        are the same however many workers render them, and prefix templates
+        are shared between the rolls.  The responses are all rendered into 
+        one array allocated at its final length.
+        
+        Args:
+            rolls: A list of (num_dice, dice_size) tuples, one per roll.  See
+            generate_roll_audio.
+            
+            seed (optional): The seed for the rolls' SeedSequence, to 
+            reproduce a batch.  Defaults to None, spawning from the roller's 
+            own seed.
+            
+            workers (optional): The number of threads to render the responses
+            on, see Speakophone.map_in_pool.  Defaults to 1, rendering them on
+            the calling thread.
+            
+        Raises:
+            ValueError if any of the rolls is invalid, see generate_roll_audio.
+            
+        Returns:
+            A list of the audio for each roll, in order, as views of one 
+            shared array.
+        """
+        if seed is None:
+            with self._lock:
+                seeds = self._seed_sequence.spawn(len(rolls))
+        else:
+            seeds = np.random.SeedSequence(seed).spawn(len(rolls))
+        
+        compiled = [self._compile_roll(num_dice, dice_size, np.random.default_rng(s)) 
+                    for (num_dice, dice_size), s in zip(rolls, seeds)]
+        ends = np.cumsum([len(prefix) + int(body[:, 1].sum()) for prefix, body in compiled]).tolist()
+        out = np.empty(ends[-1] if len(ends) > 0 else 0, dtype="int16")
+        views = [out[start:end] for start, end in zip([0] + ends[:-1], ends)]
+        
+        map_in_pool(self._render_roll, [(prefix, body, view) for (prefix, body), view in zip(compiled, views)],
+                    workers, pool="thread")
+        return views
+    
+    
+    def _compile_roll(self, num_dice, dice_size, rng):
+        """
+        Rolls the dice and chooses the phrases for a response.
+        
+        Returns:
+            prefix, body: The rendered prefix template, and the plan of 
+            (offset, length) segments into the bank for the rest.
+        """
         if num_dice < 1:
             raise ValueError("num_dice cannot be less than 1")
         if dice_size < 1:
             raise ValueError("dice_size cannot be less than 1")
-            
         
-        roll_results = roll_dice(num_dice, dice_size)
+        prefix = self._prefix(num_dice, dice_size, self._choose("intro", rng), 
+                              self._choose("d", rng), self._choose("segue", rng))
+        roll_results = roll_dice(num_dice, dice_size, rng)
         
-        results = list()
-        results.append(choice(self.intro_phrases))
-        results.append(self.number_phrases[say_number(num_dice)])
-        results.append(choice(self.d_phrases))
-        results.append(self.number_phrases[say_number(dice_size)])
-        results.append(choice(self.segue_phrases))
+        #Each distinct result is said once in the table, then spread back out
+        values, inverse = np.unique(roll_results, return_inverse=True)
+        table = self._number_table(values)
         
-        for r in roll_results:
-            txt = say_number(r)
-            results.append(self.number_phrases[txt])
-            results.append(choice(self.joining_phrases))
-        results = results[:-1]
+        #Each result is followed by a joiner, except the last
+        width = table.shape[1]
+        body = np.empty((num_dice, width + 1, 2), dtype="int64")
+        body[:, :width] = table[inverse.reshape(-1)]
+        body[:, width] = self._rows["joining"][self._choose("joining", rng, num_dice)]
+        body = body.reshape(-1, 2)[:-1]
         
-        results.append(choice(self.outro_phrases))        
+        plan = np.concatenate([body, self._rows["outro"][self._choose("outro", rng)][np.newaxis]])
+        return prefix, plan[plan[:, 1] > 0]
+    
+    
+    def _prefix(self, num_dice, dice_size, intro, d, segue):
+        """
+        Gets the rendered prefix template, Intro | num_dice | "Dee" | 
+        dice_size | Segue, for the given dice and phrase choices.
         
-        return np.hstack(results)
+        Raises:
+            ValueError if there is no file for a word of num_dice or 
+            dice_size.
+        """
+        key = "{0}d{1}:{2}:{3}:{4}".format(num_dice, dice_size, intro, d, segue)
+        if self.prefix_cache is not None:
+            audio = self.prefix_cache.get(key)
+            if audio is not None:
+                return audio
+        
+        try:
+            count = self._number_segments(num_dice)
+        except KeyError as e:
+            raise ValueError("Cannot say the number of dice {0}: there is no number phrase for {1}".format(num_dice, e))
+        try:
+            size = self._number_segments(dice_size)
+        except KeyError as e:
+            raise ValueError("Cannot say the dice size {0}: there is no number phrase for {1}".format(dice_size, e))
+        plan = np.concatenate([self._rows["intro"][intro][np.newaxis], count, 
+                               self._rows["d"][d][np.newaxis], size, 
+                               self._rows["segue"][segue][np.newaxis]])
+        audio = execute_render_plan(self.bank.buffer, plan[plan[:, 1] > 0])
+        
+        if self.prefix_cache is not None:
+            self.prefix_cache.put(key, audio)
+        return audio
+    
+    
+    def _render_roll(self, prefix, body, out=None):
+        """
+        Renders a compiled roll, the prefix followed by the body, into out or
+        a new array of exactly the right size.
+        """
+        if out is None:
+            out = np.empty(len(prefix) + int(body[:, 1].sum()), dtype="int16")
+        out[:len(prefix)] = prefix
+        execute_render_plan(self.bank.buffer, body, out[len(prefix):])
+        return out
 
 
 
+def build_dice_bundle(config_file, bundle_file, workers=1, target_fs=DEFAULT_FS):
+    """
+    Packs a whole dice voice, as described by a DiceRoller configuration 
+    file, into one bundle file.  The bundle is a SampleBank whose samples are
+    named "category/name": "number/<word>" for each number, and 
+    "<category>/<index>" for each intro, d, segue, joining and outro phrase.
+    All of the audio is in one contiguous block after the name table.
+    
+    Args:
+        config_file: The DiceRoller configuration file of the voice.
+        
+        bundle_file: The path to write the bundle to.
+        
+        workers (optional): The number of workers used to load the phrase 
+        files, defaults to 1.
+        
+        target_fs (optional): The sample frequency (in Hz) to store the 
+        phrases at, defaults to 44100 Hz.
+        
+    Returns:
+        The DiceRoller loaded from the configuration file.
+    """
+    roller = DiceRoller(config_file, workers=workers, target_fs=target_fs)
+    roller.save_bundle(bundle_file)
+    return roller
+
+
 if __name__== "__main__":
+    parser = argparse.ArgumentParser(description="Roll dice and read out the results.")
+    parser.add_argument("--build-bundle", nargs=2, metavar=("CONFIG", "BUNDLE"),
+                        help="pack the dice voice described by CONFIG into the BUNDLE file and exit")
+    args = parser.parse_args()
+    if args.build_bundle:
+        logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+        build_dice_bundle(*args.build_bundle)
+        raise SystemExit()
+    
     samp_dir = "../samples/little-scale_SP0256-AL2"
     dict_file = "../samples/CMU-SphinxDict/cmudict_SPHINX_40.txt"
     map_file = "../samples/CMU-SphinxDict/SphinxPhones_40__C64_mapping.txt"
@@ -334,7 +653,7 @@ if __name__== "__main__":
     
     
     roller = DiceRoller("../samples/DiceRoller/dice_roller_phrases.json")
-    #a = roller.generate_roll_audio(randint(1, 4), choice([2,4,6,8,10,12,20,100]))
+    #a = roller.generate_roll_audio(roller.rng.integers(1, 5), roller.rng.choice([2,4,6,8,10,12,20,100]))
     a = roller.generate_roll_audio(2, 20)
-    app.output_audio(a)
+    app.output_audio(a, fs=roller.fs)
     #app.output_audio(a, "your_roll")
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+A benchmark suite for Speakophone and the DiceRoller, run against the
+bundled samples in the repo's Samples directory.
+
+Each benchmark is timed over a number of repeats with time.perf_counter,
+then run once more under tracemalloc to record its peak memory.  Results
+are written as JSON so that runs can be kept and compared over time:
+
+    python speak_bench.py --output before.json
+    python speak_bench.py --output after.json --compare before.json
+
+Nothing is played, so the suite runs headless without a sound device.  The
+samples are loaded with their caches kept in a temporary directory, so the
+Samples directory is left untouched.
+"""
+
+from Speakophone import (Speakophone, SampleBank, load_cmu_dict, load_samples, load_allophone_map,
+                         cmu_index_path, clear_shared_cmu_dicts)
+from dice_roller import DiceRoller, say_number
+import numpy as np
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+BENCH_FORMAT_VERSION = 1
+
+WORDS = ["hello", "world", "computer", "synthesis", "the"]
+
+PHRASES = ["the quick brown fox jumps over the lazy dog",
+           "you rolled two dee twenty and got seventeen",
+           "hello world",
+           "this is a test of the emergency broadcast system"]
+
+
+def time_calls(func, repeat=5, warmup=0, setup=None):
+    """
+    Times repeated calls of a function.
+
+    Args:
+        func: The function to call, with no arguments.
+
+        repeat (optional): The number of timed calls, defaults to 5.
+
+        warmup (optional): The number of untimed calls made first, defaults
+        to 0.
+
+        setup (optional): A function called, untimed, before every call of
+        func, e.g. to clear caches for a cold start.  Defaults to None.
+
+    Returns:
+        A dict of the repeat count and the min, median, mean, p95 and max
+        time of a call in milliseconds.
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+    times = list()
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    ms = np.array(times) * 1000
+    return {"repeat": repeat, "min_ms": float(ms.min()), "median_ms": float(np.median(ms)),
+            "mean_ms": float(ms.mean()), "p95_ms": float(np.percentile(ms, 95)),
+            "max_ms": float(ms.max())}
+
+
+def peak_memory(func, setup=None):
+    """
+    Measures the peak memory allocated during one call of a function, with
+    tracemalloc.  This covers Python and NumPy allocations but not memory
+    mapped files.
+
+    Args:
+        func: The function to call, with no arguments.
+
+        setup (optional): A function called, untraced, before func.
+
+    Returns:
+        The peak traced memory in bytes.
+    """
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run_benchmark(name, func, repeat=5, warmup=0, items=None, setup=None):
+    """
+    Runs a single benchmark, catching any error so that the rest of the suite
+    still runs.
+
+    Args:
+        name (str): The benchmark's name, which is printed.
+
+        func: The function to benchmark, with no arguments.
+
+        repeat, warmup, setup (optional): As for time_calls.
+
+        items (optional): The number of items one call handles, e.g. phrases
+        in a batch.  When given, items_per_second is included.
+
+    Returns:
+        A dict of the timings from time_calls plus peak_bytes, or of the
+        error if the benchmark failed.
+    """
+    print("Running {0}".format(name), file=sys.stderr)
+    try:
+        result = time_calls(func, repeat, warmup, setup)
+        result["peak_bytes"] = peak_memory(func, setup)
+    except Exception as e:
+        return {"error": "{0}: {1}".format(type(e).__name__, e)}
+
+    if items is not None:
+        result["items"] = items
+        result["items_per_second"] = items * 1000 / result["median_ms"] if result["median_ms"] > 0 else 0.0
+    return result
+
+
+def dice_roller_for(roller, app, number, bundle_file):
+    """
+    Gets a DiceRoller which can say a number, by adding any of its words 
+    which roller has no phrase for as rendered by a Speakophone.  The 
+    bundled number phrases only go up to "twenty".
+
+    Args:
+        roller: The DiceRoller to start from.
+
+        app: The Speakophone to render the missing words with.
+
+        number (int): The number to be able to say.
+
+        bundle_file: The path to save the new roller's dice voice bundle to.
+
+    Returns:
+        roller itself if it can already say the number, or else a new 
+        DiceRoller loaded from bundle_file.
+    """
+    missing = [w for w in say_number(number).split(" ") if w not in roller.number_phrases]
+    if len(missing) == 0:
+        return roller
+    sounds = {name: roller.bank[name] for name in roller.bank}
+    for word in missing:
+        sounds["number/" + word] = app.generate_audio(word)
+    SampleBank.pack(sounds, roller.fs).save(bundle_file)
+    return DiceRoller(bundle_file)
+
+
+def run_suite(sample_dir, dict_file, map_file, dice_config, repeat=5, workers=None,
+              large_dice=1000, quick=False):
+    """
+    Runs every benchmark.
+
+    Args:
+        sample_dir: The directory of allophone ".wav" samples.
+
+        dict_file: The CMU Sphinx Dictionary file.
+
+        map_file: The allophone mapping file.
+
+        dice_config: The DiceRoller configuration file.
+
+        repeat (optional): The number of timed calls of each fast benchmark,
+        defaults to 5.
+
+        workers (optional): The number of worker processes for the batch
+        benchmark, defaults to None, one per CPU.
+
+        large_dice (optional): The number of d20 in the large roll 
+        benchmark, defaults to 1000.  Words of the number which the dice 
+        voice has no phrase for are rendered with the Speakophone voice.  
+        The batch of rolls benchmark rolls the same dice 20 at a time, the 
+        most the bundled number phrases can say alone.
+
+        quick (optional): If True, run the slow benchmarks (dictionary
+        parsing and cold construction) only once.  Defaults to False.
+
+    Returns:
+        A dict of each benchmark's results keyed by name.
+    """
+    slow_repeat = 1 if quick else max(1, repeat // 2)
+    results = dict()
+    cache_dir = tempfile.mkdtemp(prefix="speak_bench_")
+    cache_file = os.path.join(cache_dir, "samples.npz")
+
+    def cold_samples():
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+    try:
+        results["load_cmu_dict"] = run_benchmark(
+            "load_cmu_dict", lambda: load_cmu_dict(dict_file), slow_repeat)
+        results["load_samples_cold"] = run_benchmark(
+            "load_samples_cold", lambda: load_samples(sample_dir, cache_file=cache_file),
+            repeat, setup=cold_samples)
+        results["load_samples_warm"] = run_benchmark(
+            "load_samples_warm", lambda: load_samples(sample_dir, cache_file=cache_file),
+            repeat, warmup=1)
+        results["load_allophone_map"] = run_benchmark(
+            "load_allophone_map", lambda: load_allophone_map(map_file), repeat)
+
+        #Constructing the voice writes the sample cache next to the samples and
+        #the dictionary index next to the dictionary, so build from copies in
+        #the temporary directory
+        voice_dir = os.path.join(cache_dir, "voice")
+        shutil.copytree(sample_dir, voice_dir)
+        voice_cache = os.path.join(voice_dir, ".speakophone_samples.npz")
+        voice_dict = os.path.join(cache_dir, os.path.basename(dict_file))
+        shutil.copy2(dict_file, voice_dict)
+        voice_index = cmu_index_path(voice_dict)
+
+        def cold_voice():
+            clear_shared_cmu_dicts()
+            for path in (voice_cache, voice_index):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        def construct(plan_cache_bytes=1024 * 1024):
+            return Speakophone(voice_dir, voice_dict, map_file, plan_cache_bytes=plan_cache_bytes)
+
+        results["speakophone_cold"] = run_benchmark("speakophone_cold", construct,
+                                                    slow_repeat, setup=cold_voice)
+        results["speakophone_warm"] = run_benchmark("speakophone_warm", construct,
+                                                    repeat, warmup=1)
+
+        #Without the plan cache, so that repeats time the lookup and gather of
+        #every phrase rather than a cache hit
+        app = construct(plan_cache_bytes=0)
+        cached_app = construct()
+        for word in WORDS:
+            results["word:" + word] = run_benchmark(
+                "word:" + word, lambda: app.generate_audio(word), repeat * 10, warmup=1)
+        for phrase in PHRASES:
+            results["phrase:" + phrase] = run_benchmark(
+                "phrase:" + phrase, lambda: app.generate_audio(phrase), repeat * 10, warmup=1)
+        for phrase in PHRASES:
+            results["phrase_cached:" + phrase] = run_benchmark(
+                "phrase_cached:" + phrase, lambda: cached_app.generate_audio(phrase), 
+                repeat * 10, warmup=1)
+
+        batch = PHRASES * 25
+        results["batch_inline"] = run_benchmark(
+            "batch_inline", lambda: app.generate_batch(batch, workers=1),
+            repeat, items=len(batch))
+        results["batch_workers"] = run_benchmark(
+            "batch_workers", lambda: app.generate_batch(batch, workers=workers),
+            slow_repeat, items=len(batch))
+
+        roller = DiceRoller(dice_config)
+        results["roll:2d6"] = run_benchmark(
+            "roll:2d6", lambda: roller.generate_roll_audio(2, 6), repeat * 10, warmup=1)
+        large_roller = dice_roller_for(roller, app, large_dice, os.path.join(cache_dir, "large.dice"))
+        name = "roll:{0}d20".format(large_dice)
+        results[name] = run_benchmark(
+            name, lambda: large_roller.generate_roll_audio(large_dice, 20), repeat, warmup=1)
+        rolls = [(20, 20)] * (large_dice // 20)
+        if large_dice % 20 > 0:
+            rolls.append((large_dice % 20, 20))
+        name = "rolls:{0}x20d20".format(len(rolls))
+        results[name] = run_benchmark(
+            name, lambda: roller.generate_rolls(rolls), repeat, warmup=1, items=len(rolls))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+def environment():
+    """
+    Describes the machine and software the benchmarks ran on.
+    """
+    return {"timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count()}
+
+
+def compare(results, baseline):
+    """
+    Compares the median times of a run against a baseline run.
+
+    Args:
+        results: The benchmark results of this run, keyed by name.
+
+        baseline: The benchmark results of the baseline run, keyed by name.
+
+    Returns:
+        A dict of the ratio of this run's median time to the baseline's,
+        keyed by the names of benchmarks which succeeded in both runs.  A
+        ratio above 1 is a slowdown.
+    """
+    ratios = dict()
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or "median_ms" not in result or "median_ms" not in base:
+            continue
+        if base["median_ms"] > 0:
+            ratios[name] = result["median_ms"] / base["median_ms"]
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Speakophone and the DiceRoller "
+                                                 "on the bundled samples.")
+    parser.add_argument("--samples", default="../Samples/Keith-AllophonesWords-v2",
+                        help="directory of allophone .wav samples")
+    parser.add_argument("--dict", default="../Samples/CMU-SphinxDict/cmudict_SPHINX_40.txt",
+                        help="CMU Sphinx dictionary file")
+    parser.add_argument("--map", default="../Samples/Keith-AllophonesWords-v2/SphinxPhones_40__Keith_mapping.txt",
+                        help="allophone mapping file")
+    parser.add_argument("--dice-config", default="../Samples/DiceRoller/dice_roller_phrases.json",
+                        help="DiceRoller configuration file")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timed calls per benchmark (default: 5)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes for the batch benchmark (default: one per CPU)")
+    parser.add_argument("--large-dice", type=int, default=1000,
+                        help="number of d20 in the large roll and batch of rolls benchmarks (default: 1000)")
+    parser.add_argument("--quick", action="store_true",
+                        help="run the slow benchmarks only once")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the JSON results to FILE instead of stdout")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="include the ratio of each median time to a previous run's JSON results")
+    args = parser.parse_args()
+
+    #Only warnings from the library, so that its logging does not skew the timings
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    results = run_suite(args.samples, args.dict, args.map, args.dice_config, args.repeat,
+                        args.workers, args.large_dice, args.quick)
+
+    report = {"version": BENCH_FORMAT_VERSION, "environment": environment(), "results": results}
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            report["compare"] = compare(results, json.load(baseline_file)["results"])
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(text + "\n")
+        print("Wrote {0}".format(args.output), file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__== "__main__":
+    main()
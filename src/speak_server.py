@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+"""
+A local speech synthesis server which keeps Speakophone voices loaded and
+answers phrase requests over HTTP, on a TCP port or a Unix socket.
+
+Requests:
+    POST /speak?voice=NAME&format=wav   The body is the phrase (UTF-8 text).
+    GET  /speak?text=PHRASE&voice=NAME&format=pcm
+    GET  /voices                        A JSON list of the loaded voices.
+    GET  /stats                         JSON request counters and voice metrics.
+
+Audio is returned as a ".wav" file (format=wav, the default) or as raw mono
+"int16" little-endian PCM (format=pcm).  A phrase with an unknown word gets
+a 400 response with the error message as the body.
+
+Also contains a small client and a load test for measuring the server.
+"""
+
+from Speakophone import Speakophone, DEFAULT_FS
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import scipy.io.wavfile as wv
+import numpy as np
+import argparse
+import asyncio
+import io
+import json
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+def encode_audio(audio, fmt, fs=DEFAULT_FS):
+    """
+    Encodes audio for an HTTP response.
+
+    Args:
+        audio: The NumPy array of "int16" samples to encode.
+
+        fmt (str): "wav" for a ".wav" file or "pcm" for raw little-endian PCM.
+
+        fs (optional): The sample frequency (in Hz) of the audio, defaults to
+        44100 Hz.
+
+    Raises:
+        ValueError if fmt is not a known format.
+
+    Returns:
+        content_type, payload: The MIME type and the encoded bytes.
+    """
+    if fmt == "pcm":
+        return "audio/L16; rate={0}; channels=1".format(fs), audio.astype("<i2").tobytes()
+    if fmt == "wav":
+        buffer = io.BytesIO()
+        wv.write(buffer, fs, audio)
+        return "audio/wav", buffer.getvalue()
+    raise ValueError("Unknown audio format \"{0}\"".format(fmt))
+
+
+def _render(app, phrase, fmt):
+    """
+    Generates and encodes a phrase.  Runs on the server's executor.
+    """
+    return encode_audio(app.generate_audio(phrase), fmt, app.fs)
+
+
+class SpeakServer:
+
+    """
+    Serves speech from one or more loaded Speakophone voices.  Each request
+    is parsed on the event loop, while synthesis and encoding run on an
+    executor so that the loop stays responsive.  Concurrent requests for the
+    same phrase, voice and format are coalesced into a single synthesis whose
+    result is shared.
+
+    Args:
+        voices: A dict of the Speakophone voices to serve, keyed by name.  The
+        first voice is the default.
+
+        executor (optional): The concurrent.futures executor to synthesize
+        on, defaults to a ThreadPoolExecutor.
+
+    Attributes:
+        requests: The number of requests received.
+
+        syntheses: The number of phrases actually synthesized.
+
+        coalesced: The number of requests which shared an in-flight synthesis.
+
+        errors: The number of requests answered with an error.
+    """
+
+    def __init__(self, voices, executor=None):
+        if len(voices) == 0:
+            raise ValueError("At least one voice is required")
+        self.voices = voices
+        self.default_voice = next(iter(voices))
+        self.executor = executor if executor is not None else ThreadPoolExecutor()
+        self.requests = 0
+        self.syntheses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self._inflight = dict()
+        self._server = None
+
+
+    async def start(self, host="127.0.0.1", port=8765, unix_path=None):
+        """
+        Starts listening for requests.
+
+        Args:
+            host (optional): The address to listen on, defaults to localhost.
+
+            port (optional): The TCP port to listen on, defaults to 8765.  Use
+            0 to pick any free port.
+
+            unix_path (optional): If given, listen on this Unix socket path
+            instead of a TCP port.
+
+        Returns:
+            The asyncio server.
+        """
+        if unix_path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=unix_path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+
+    @property
+    def port(self):
+        """
+        The TCP port the server is listening on.
+        """
+        return self._server.sockets[0].getsockname()[1]
+
+
+    async def serve_forever(self):
+        """
+        Serves requests until cancelled.  start must be called first.
+        """
+        await self._server.serve_forever()
+
+
+    async def close(self):
+        """
+        Stops listening and waits for the server to close.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+
+
+    async def speak(self, voice, phrase, fmt="wav"):
+        """
+        Synthesizes and encodes a phrase on the executor, sharing the result
+        with any identical request already in flight.
+
+        Args:
+            voice (str): The name of the voice to speak with.
+
+            phrase (str): The phrase to speak.
+
+            fmt (optional): The audio format, see encode_audio.  Defaults to
+            "wav".
+
+        Raises:
+            KeyError if the voice is not loaded.
+
+            ValueError if a word from the phrase cannot be found in the
+            reference dictionary, or fmt is not a known format.
+
+        Returns:
+            content_type, payload: The MIME type and the encoded audio.
+        """
+        app = self.voices[voice]
+        key = (voice, " ".join(app.phrase_words(phrase)), fmt)
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, _render, app, phrase, fmt)
+        self._inflight[key] = future
+        self.syntheses += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+
+    def stats(self):
+        """
+        Gets the server's request counters, along with the synthesis 
+        metrics of each voice.
+
+        Returns:
+            A dict of the counters, the number of requests in flight, and a
+            "voices" dict of each voice's SynthesisMetrics snapshot.
+        """
+        return {"requests": self.requests, "syntheses": self.syntheses,
+                "coalesced": self.coalesced, "errors": self.errors,
+                "in_flight": len(self._inflight),
+                "voices": {name: app.metrics.snapshot() for name, app in self.voices.items()}}
+
+
+    async def _dispatch(self, method, target, body):
+        """
+        Routes a parsed request.
+
+        Returns:
+            status, content_type, payload: The response to send.
+        """
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/voices" and method == "GET":
+            return 200, "application/json", json.dumps(list(self.voices)).encode("utf-8")
+        if url.path == "/stats" and method == "GET":
+            return 200, "application/json", json.dumps(self.stats()).encode("utf-8")
+        if url.path != "/speak":
+            return 404, "text/plain", b"Not found"
+
+        if method == "POST":
+            phrase = body.decode("utf-8")
+        elif method == "GET":
+            phrase = query.get("text", "")
+        else:
+            return 405, "text/plain", b"Use GET or POST"
+
+        voice = query.get("voice", self.default_voice)
+        if voice not in self.voices:
+            return 404, "text/plain", "Unknown voice \"{0}\"".format(voice).encode("utf-8")
+
+        content_type, payload = await self.speak(voice, phrase, query.get("format", "wav"))
+        return 200, content_type, payload
+
+
+    async def _handle(self, reader, writer):
+        """
+        Reads one HTTP request from a connection, answers it and closes the
+        connection.
+        """
+        self.requests += 1
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            body = await reader.readexactly(length) if length > 0 else b""
+
+            status, content_type, payload = await self._dispatch(method, target, body)
+        except (ValueError, UnicodeDecodeError, asyncio.IncompleteReadError) as e:
+            status, content_type, payload = 400, "text/plain", str(e).encode("utf-8")
+        except Exception as e:
+            status, content_type, payload = 500, "text/plain", str(e).encode("utf-8")
+
+        if status != 200:
+            self.errors += 1
+
+        header = ("HTTP/1.1 {0} {1}\r\nContent-Type: {2}\r\nContent-Length: {3}\r\n"
+                  "Connection: close\r\n\r\n").format(status, REASONS[status],
+                                                      content_type, len(payload))
+        try:
+            writer.write(header.encode("latin-1") + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def request_speech(phrase, host="127.0.0.1", port=8765, voice=None,
+                         fmt="wav", unix_path=None):
+    """
+    A minimal client which asks a SpeakServer to speak a phrase.
+
+    Args:
+        phrase (str): The phrase to speak.
+
+        host (optional): The server address, defaults to localhost.
+
+        port (optional): The server's TCP port, defaults to 8765.
+
+        voice (optional): The name of the voice, defaults to the server's
+        default voice.
+
+        fmt (optional): "wav" or "pcm", defaults to "wav".
+
+        unix_path (optional): If given, connect to this Unix socket instead.
+
+    Returns:
+        status, payload: The HTTP status code and the response body.
+    """
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    target = "/speak?format={0}".format(fmt)
+    if voice is not None:
+        target += "&voice={0}".format(voice)
+    body = phrase.encode("utf-8")
+    writer.write(("POST {0} HTTP/1.1\r\nHost: {1}\r\nContent-Length: {2}\r\n"
+                  "Connection: close\r\n\r\n").format(target, host, len(body)).encode("latin-1") + body)
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    return status, payload
+
+
+async def load_test(phrases, requests=200, concurrency=16, host="127.0.0.1",
+                    port=8765, voice=None, fmt="wav", unix_path=None):
+    """
+    Sends many concurrent requests to a SpeakServer and measures latency and
+    throughput.  The phrases are cycled through in order.
+
+    Args:
+        phrases: A list of phrases to request.
+
+        requests (optional): The total number of requests, defaults to 200.
+
+        concurrency (optional): The number of requests kept in flight at
+        once, defaults to 16.
+
+        host, port, voice, fmt, unix_path (optional): As for request_speech.
+
+    Returns:
+        A dict of the request and error counts, elapsed seconds, requests per
+        second and latency percentiles in milliseconds.
+    """
+    latencies = list()
+    errors = 0
+    next_request = 0
+
+    async def client():
+        nonlocal errors, next_request
+        while next_request < requests:
+            phrase = phrases[next_request % len(phrases)]
+            next_request += 1
+            start = time.perf_counter()
+            try:
+                status, _ = await request_speech(phrase, host, port, voice, fmt, unix_path)
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    ms = np.array(latencies) * 1000
+    return {"requests": len(latencies), "errors": errors, "seconds": elapsed,
+            "requests_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+            "latency_ms": {"p50": float(np.percentile(ms, 50)),
+                           "p90": float(np.percentile(ms, 90)),
+                           "p99": float(np.percentile(ms, 99)),
+                           "max": float(ms.max())}}
+
+
+def load_voices(voice_specs, dict_file, word_cache_bytes=0, target_fs=DEFAULT_FS):
+    """
+    Loads the voices described on the command line.
+
+    Args:
+        voice_specs: A list of "NAME=SAMPLE_DIR,MAP_FILE" strings.
+
+        dict_file: The CMU Sphinx Dictionary file shared by the voices.
+
+        word_cache_bytes (optional): The word cache budget for each voice.
+        
+        target_fs (optional): The sample frequency of the voices in Hz, 
+        defaults to 44100 Hz.
+
+    Returns:
+        A dict of the loaded Speakophone voices keyed by name.
+    """
+    voices = dict()
+    for spec in voice_specs:
+        name, _, paths = spec.partition("=")
+        sample_dir, _, map_file = paths.partition(",")
+        voices[name] = Speakophone(sample_dir=sample_dir, dict_file_path=dict_file,
+                                   allo_map_file_path=map_file,
+                                   word_cache_bytes=word_cache_bytes,
+                                   target_fs=target_fs)
+    return voices
+
+
+async def serve(server, host, port, unix_path):
+    await server.start(host, port, unix_path)
+    logger.info("Serving voices %s on %s", list(server.voices),
+                unix_path if unix_path is not None else "{0}:{1}".format(host, server.port))
+    await server.serve_forever()
+
+
+async def local_load_test(server, phrases, requests, concurrency, fmt):
+    await server.start(port=0)
+    try:
+        return await load_test(phrases, requests, concurrency, port=server.port, fmt=fmt)
+    finally:
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Speakophone synthesis server.")
+    parser.add_argument("command", choices=["serve", "say", "loadtest"],
+                        help="serve voices, request one phrase, or load test a server")
+    parser.add_argument("--voice", action="append", metavar="NAME=SAMPLES,MAP",
+                        help="a voice to serve (repeatable); defaults to the Keith voice")
+    parser.add_argument("--dict", default="../Samples/CMU-SphinxDict/cmudict_SPHINX_40.txt",
+                        help="CMU Sphinx dictionary file")
+    parser.add_argument("--word-cache-mb", type=int, default=16,
+                        help="word cache budget per voice in MB (default: 16)")
+    parser.add_argument("--rate", type=int, default=DEFAULT_FS,
+                        help="sample rate of the served audio in Hz (default: 44100)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", metavar="PATH", help="use a Unix socket instead of TCP")
+    parser.add_argument("--format", choices=["wav", "pcm"], default="wav")
+    parser.add_argument("--phrases", metavar="FILE",
+                        help="phrases for say/loadtest, one per line")
+    parser.add_argument("--output", default="speech.wav", help="output file for say")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--local", action="store_true",
+                        help="loadtest: start a server in this process on a free localhost port")
+    parser.add_argument("--log-level", default="info",
+                        choices=["debug", "info", "warning", "error"],
+                        help="level of the messages logged to stderr (default: info)")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)s %(name)s: %(message)s")
+
+    voice_specs = args.voice or ["keith=../Samples/Keith-AllophonesWords-v2,"
+                                 "../Samples/Keith-AllophonesWords-v2/SphinxPhones_40__Keith_mapping.txt"]
+    if args.phrases:
+        with open(args.phrases, "r") as f:
+            phrases = [line.strip() for line in f if line.strip() != ""]
+    else:
+        phrases = ["hello world", "the quick brown fox", "you rolled two dee twenty"]
+
+    if args.command == "say":
+        status, payload = asyncio.run(request_speech(phrases[0], args.host, args.port,
+                                                     fmt=args.format, unix_path=args.unix))
+        if status != 200:
+            print("Error {0}: {1}".format(status, payload.decode("utf-8", "replace")))
+            return
+        with open(args.output, "wb") as f:
+            f.write(payload)
+        print("Wrote {0}".format(args.output))
+    elif args.command == "loadtest" and not args.local:
+        results = asyncio.run(load_test(phrases, args.requests, args.concurrency, args.host,
+                                        args.port, fmt=args.format, unix_path=args.unix))
+        print(json.dumps(results, indent=2))
+    else:
+        server = SpeakServer(load_voices(voice_specs, args.dict, args.word_cache_mb * 1024 * 1024,
+                                         args.rate))
+        if args.command == "serve":
+            try:
+                asyncio.run(serve(server, args.host, args.port, args.unix))
+            except KeyboardInterrupt:
+                print("Keyboard Interrupt")
+        else:
+            results = asyncio.run(local_load_test(server, phrases, args.requests,
+                                                  args.concurrency, args.format))
+            results["server"] = server.stats()
+            print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()